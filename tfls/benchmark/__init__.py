@@ -0,0 +1,2 @@
+# Offline replay benchmark: a corpus recorded from the HTTP cache, a local
+# stand-in for tfls.tj.edu.cn serving it, and the `scrapy benchmark` command.
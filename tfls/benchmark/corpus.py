@@ -0,0 +1,30 @@
+import json
+from hashlib import sha1
+from pathlib import Path
+
+"""
+A corpus is a directory with an index.json mapping request urls to the status, raw headers and body file of their response.
+Bodies are stored once per content under bodies/.
+"""
+def record(storage, corpusdir):
+    corpusdir = Path(corpusdir)
+    Path(corpusdir, "bodies").mkdir(parents=True, exist_ok=True)
+    index = {}
+    for _, metadata, rawheaders, body in storage.iter_entries():
+        if metadata.get("method", "GET") != "GET":
+            continue
+        name = f"bodies/{sha1(body).hexdigest()}"
+        if not Path(corpusdir, name).exists():
+            Path(corpusdir, name).write_bytes(body)
+        index[metadata["url"]] = {
+            "status": metadata["status"],
+            "headers": rawheaders.decode("latin-1"),
+            "body": name,
+        }
+    with open(corpusdir / "index.json", "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    return index
+
+def load(corpusdir):
+    with open(Path(corpusdir, "index.json")) as f:
+        return json.load(f)
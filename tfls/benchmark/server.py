@@ -0,0 +1,71 @@
+import argparse
+import random
+import time
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from w3lib.http import headers_raw_to_dict
+
+from .corpus import load
+
+"""
+Serves a recorded corpus as a stand-in for tfls.tj.edu.cn. Point the crawler at it as an HTTP proxy,
+so requests keep their original urls. Every response is delayed by `latency` seconds plus up to `jitter`,
+and a fraction `error_rate` of them fail with a 503.
+"""
+class CorpusHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, *args, corpus, latency, jitter, error_rate, **kwargs):
+        self.corpus = corpus
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        url = self.path if "://" in self.path else f"http://{self.headers['Host']}{self.path}"
+        time.sleep(self.latency + random.random() * self.jitter)
+        entry = self.corpus["index"].get(url)
+        if entry is None:
+            return self._send(404, {}, b"")
+        if random.random() < self.error_rate:
+            return self._send(503, {}, b"")
+        headers = headers_raw_to_dict(entry["headers"].encode("latin-1"))
+        body = Path(self.corpus["dir"], entry["body"]).read_bytes()
+        self._send(entry["status"], headers, body)
+
+    def _send(self, status, headers, body):
+        self.send_response(status)
+        for name, values in headers.items():
+            if name.lower() in (b"content-length", b"transfer-encoding", b"connection"):
+                continue
+            for value in values:
+                self.send_header(name.decode("latin-1"), value.decode("latin-1"))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a recorded corpus as a stand-in for tfls.tj.edu.cn")
+    parser.add_argument("corpus")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    corpus = {"dir": args.corpus, "index": load(args.corpus)}
+    handler = partial(CorpusHandler, corpus=corpus, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), handler)
+    print(f"Serving {len(corpus['index'])} urls on port {server.server_port}", flush=True)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+# This package contains the custom scrapy commands of the project.
+#
+# Please refer to the documentation for information on how to create and manage
+# your commands.
@@ -0,0 +1,169 @@
+import cProfile
+import inspect
+import json
+import os
+import pstats
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.misc import load_object
+
+from ..benchmark import corpus
+from ..extensions.httpcache import PackedCacheStorage
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_LEVEL": "WARNING"}
+
+    def syntax(self):
+        return "record <corpus> | run <corpus>"
+
+    def short_desc(self):
+        return "Record a replay corpus from the HTTP cache or benchmark the crawl against it"
+
+    def long_desc(self):
+        return (
+            "`record` exports the cached responses of the spider into a corpus directory. "
+            "`run` serves the corpus from a local HTTP server and crawls it with the full pipeline chain, "
+            "printing pages/s, items/s, per-stage CPU time and peak RSS as JSON."
+        )
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--spider", default="tfls", help="spider to record or run (default: %(default)s)")
+        parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+        parser.add_argument("--jitter", type=float, default=0.0, help="random seconds added on top of --latency")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of responses failing with 503")
+        parser.add_argument("--no-profile", action="store_true", help="skip the per-stage CPU profile, which slows the crawl down and runs the worker pools inline")
+        parser.add_argument("-o", "--output", help="save the result to this file")
+        parser.add_argument("--baseline", help="compare the result against a previously saved one")
+
+    def run(self, args, opts):
+        if len(args) != 2 or args[0] not in ("record", "run"):
+            raise UsageError()
+        if args[0] == "record":
+            self._record(args[1], opts)
+        else:
+            self._run(args[1], opts)
+
+    def _record(self, corpusdir, opts):
+        storage = PackedCacheStorage(self.settings)
+        storage.open(opts.spider)
+        index = corpus.record(storage, corpusdir)
+        storage.close()
+        print(f"Recorded {len(index)} responses to {corpusdir}")
+
+    def _run(self, corpusdir, opts):
+        workdir = tempfile.mkdtemp(prefix="tfls-benchmark-")
+        try:
+            result = self._benchmark(corpusdir, opts, workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        if opts.baseline:
+            with open(opts.baseline) as f:
+                result["baseline"] = self._compare(result, json.load(f))
+        if opts.output:
+            with open(opts.output, "w") as f:
+                json.dump(result, f, indent=4, sort_keys=True)
+        print(json.dumps(result, indent=4, sort_keys=True))
+
+    def _benchmark(self, corpusdir, opts, workdir):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        server = subprocess.Popen(
+            [sys.executable, "-m", "tfls.benchmark.server", corpusdir, "--port", str(port),
+             "--latency", str(opts.latency), "--jitter", str(opts.jitter), "--error-rate", str(opts.error_rate)],
+            stdout=subprocess.PIPE, text=True,
+        )
+        server.stdout.readline()
+        # requests keep their original urls and are answered by the local server acting as a proxy
+        os.environ["http_proxy"] = f"http://127.0.0.1:{port}"
+        os.environ.pop("no_proxy", None)
+        for name, value in {
+            "HTTPCACHE_ENABLED": False,
+            "IMAGES_STORE": f"{workdir}/images",
+            "IMAGES_INDEX": f"{workdir}/images.json",
+            "FILES_STORE": f"{workdir}/files",
+            "FILES_INDEX": f"{workdir}/files.json",
+            "DEPLOY_MANIFEST_DIR": f"{workdir}/deploy",
+            "SEARCH_INDEX_DIR": f"{workdir}/search",
+            "MARKDOWN_OUTPUT_DIR": f"{workdir}/output",
+            "MANIFEST_FILE": f"{workdir}/manifest.json",
+            "METRICS_PROMETHEUS_FILE": f"{workdir}/metrics.prom",
+            "METRICS_JSON_FILE": f"{workdir}/metrics.json",
+        }.items():
+            self.settings.set(name, value, priority="cmdline")
+        if not opts.no_profile:
+            # the profiler and the CPU time only see this process, so the Markdown conversion and the derivatives run inline
+            self.settings.set("MARKDOWN_WORKERS", 0, priority="cmdline")
+            self.settings.set("IMAGES_DERIVATIVE_WORKERS", 0, priority="cmdline")
+
+        crawler = self.crawler_process.create_crawler(opts.spider)
+        profile = None if opts.no_profile else cProfile.Profile(time.process_time)
+        self.crawler_process.crawl(crawler)
+        start, cpu = time.perf_counter(), time.process_time()
+        try:
+            if profile:
+                profile.enable()
+            self.crawler_process.start()
+        finally:
+            if profile:
+                profile.disable()
+            server.terminate()
+            server.wait()
+        elapsed = time.perf_counter() - start
+
+        stats = crawler.stats.get_stats()
+        result = {
+            "elapsed": elapsed,
+            "cpu": time.process_time() - cpu,
+            "pages": stats.get("response_received_count", 0),
+            "items": stats.get("item_scraped_count", 0),
+            "pages_per_second": stats.get("response_received_count", 0) / elapsed,
+            "items_per_second": stats.get("item_scraped_count", 0) / elapsed,
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "peak_rss_children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+            "stages": self._stages(profile, crawler) if profile else {},
+        }
+        if Path(workdir, "metrics.json").exists():
+            with open(Path(workdir, "metrics.json")) as f:
+                result["metrics"] = json.load(f)
+        return result
+
+    def _stages(self, profile, crawler):
+        """CPU seconds spent in the entry points of each stage, including everything they call."""
+        stages = {
+            "spider": [crawler.spidercls.parse, crawler.spidercls.parse_sidebar],
+        }
+        for path in crawler.settings.getwithbase("DOWNLOADER_MIDDLEWARES"):
+            if path.startswith("tfls."):
+                stages[path] = [load_object(path).process_response]
+        for path in crawler.settings.getwithbase("ITEM_PIPELINES"):
+            cls = load_object(path)
+            stages[path] = [getattr(cls, name) for name in ("process_item", "media_to_download", "media_downloaded") if hasattr(cls, name)]
+        cumulative = {key: value[3] for key, value in pstats.Stats(profile).stats.items()}
+        result = {}
+        for stage, functions in stages.items():
+            codes = {(f.__code__.co_filename, f.__code__.co_firstlineno, f.__code__.co_name) for f in map(inspect.unwrap, functions)}
+            result[stage] = sum(cumulative.get(code, 0) for code in codes)
+        return result
+
+    def _compare(self, result, baseline):
+        """Ratio of each metric to the baseline, above 1 means more than the baseline."""
+        comparison = {}
+        for key in ("elapsed", "cpu", "pages_per_second", "items_per_second", "peak_rss"):
+            if baseline.get(key):
+                comparison[key] = result[key] / baseline[key]
+        for stage, seconds in result["stages"].items():
+            if baseline.get("stages", {}).get(stage):
+                comparison[stage] = seconds / baseline["stages"][stage]
+        return comparison
@@ -0,0 +1,63 @@
+import json
+from pathlib import Path
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from ..extensions.deploy import load
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_LEVEL": "WARNING"}
+
+    def syntax(self):
+        return "[run manifest ...]"
+
+    def short_desc(self):
+        return "Print the files to upload and delete to deploy one or more crawls"
+
+    def long_desc(self):
+        return (
+            "Combines the given run manifests, oldest first, into the minimal set of files to upload and delete. "
+            "Without arguments the latest run manifest in DEPLOY_MANIFEST_DIR is used. "
+            "Paths are printed relative to the current directory, one per line and prefixed with `upload` or `delete`."
+        )
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--since", help="combine all run manifests after this one")
+        parser.add_argument("--tree", action="append", help="only list files of this tree, may be repeated")
+        parser.add_argument("--json", action="store_true", help="print the sets as JSON grouped by tree")
+
+    def run(self, args, opts):
+        runs = sorted(Path(self.settings.get("DEPLOY_MANIFEST_DIR")).glob("run-*.json"))
+        if args:
+            runs = [Path(arg) for arg in args]
+        elif opts.since:
+            runs = [run for run in runs if run.name > Path(opts.since).name]
+        elif runs:
+            runs = runs[-1:]
+        if not runs and not opts.since:
+            raise UsageError("No run manifest found, crawl with DEPLOY_MANIFEST_DIR set first")
+
+        trees = {}
+        for run in runs:
+            for name, changes in load(run)['trees'].items():
+                if opts.tree and name not in opts.tree:
+                    continue
+                tree = trees.setdefault(name, {'root': changes['root'], 'upload': set(), 'delete': set()})
+                for path in [*changes['added'], *changes['modified']]:
+                    tree['upload'].add(path)
+                    tree['delete'].discard(path)
+                for path in changes['deleted']:
+                    tree['upload'].discard(path)
+                    tree['delete'].add(path)
+
+        if opts.json:
+            print(json.dumps({name: {'root': tree['root'], 'upload': sorted(tree['upload']), 'delete': sorted(tree['delete'])}
+                              for name, tree in sorted(trees.items())}, indent=4))
+            return
+        for name, tree in sorted(trees.items()):
+            for action in ('upload', 'delete'):
+                for path in sorted(tree[action]):
+                    print(f"{action}\t{Path(tree['root'], path).as_posix()}")
@@ -0,0 +1,39 @@
+import gzip
+import pickle
+from pathlib import Path
+
+from scrapy.commands import ScrapyCommand
+from scrapy.utils.project import data_path
+
+from ..extensions.httpcache import PackedCacheStorage
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_LEVEL": "WARNING"}
+
+    def syntax(self):
+        return "[spider ...]"
+
+    def short_desc(self):
+        return "Migrate the filesystem HTTP cache into packed cache storage"
+
+    def run(self, args, opts):
+        cachedir = Path(data_path(self.settings["HTTPCACHE_DIR"]))
+        names = args or sorted(path.name for path in cachedir.iterdir() if path.is_dir())
+        _open = gzip.open if self.settings.getbool("HTTPCACHE_GZIP") else open
+        for name in names:
+            storage = PackedCacheStorage(self.settings)
+            storage.open(name)
+            count = 0
+            for metapath in sorted(Path(cachedir, name).glob("*/*/pickled_meta")):
+                rpath = metapath.parent
+                with _open(metapath, "rb") as f:
+                    metadata = pickle.load(f)
+                with _open(rpath / "response_headers", "rb") as f:
+                    rawheaders = f.read()
+                with _open(rpath / "response_body", "rb") as f:
+                    body = f.read()
+                storage.append(rpath.name, metadata, rawheaders, body)
+                count += 1
+            storage.close()
+            print(f"Migrated {count} entries from {Path(cachedir, name)} to {storage.packpath}")
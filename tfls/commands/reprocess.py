@@ -0,0 +1,100 @@
+import multiprocessing
+from itertools import islice
+from pathlib import Path
+
+from scrapy.commands import ScrapyCommand
+from scrapy.http import Headers
+from w3lib.http import headers_raw_to_dict
+
+from .. import reprocess
+from ..extensions.deploy import DeployManifest
+from ..extensions.httpcache import PackedCacheStorage
+from ..manifest import CrawlManifest
+from ..pipelines import DeduplicatePipeline, _derivative_format, _render_markdown, _search_document
+from ..search import SearchIndex
+from ..writer import write_atomic
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_LEVEL": "WARNING"}
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Rebuild the Markdown output from the HTTP cache without crawling"
+
+    def long_desc(self):
+        return (
+            "Runs every cached article through the spider, the image and attachment rewriting and the Markdown conversion "
+            "in a pool of worker processes, and exports the result like a crawl would. Nothing is downloaded: images and "
+            "attachments are taken from the indexes of earlier crawls. Articles recorded as duplicates in the manifest are skipped."
+        )
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--spider", default="tfls", help="spider whose cache is reprocessed (default: %(default)s)")
+        parser.add_argument("-j", "--workers", type=int, help="worker processes (default: one per CPU)")
+        parser.add_argument("--batch", type=int, default=512, help="cached responses read at once (default: %(default)s)")
+
+    def run(self, args, opts):
+        settings = self.settings
+        spidercls = self.crawler_process.spider_loader.load(opts.spider)
+        options = {
+            'images_index': settings.get("IMAGES_INDEX"),
+            'images_store': settings.get("IMAGES_STORE"),
+            'images_cdn_url': settings.get("IMAGES_CDN_URL"),
+            'images_sizes': settings.get("IMAGES_DERIVATIVE_SIZES"),
+            'derivative_widths': [int(width) for width in settings.getlist("IMAGES_DERIVATIVE_WIDTHS")],
+            'derivative_format': _derivative_format(settings.get("IMAGES_DERIVATIVE_FORMAT", "WEBP")),
+            'files_index': settings.get("FILES_INDEX"),
+            'files_store': settings.get("FILES_STORE"),
+            'files_cdn_url': settings.get("FILES_CDN_URL"),
+            'dedup_min_length': settings.getint("DEDUP_MIN_LENGTH", 50),
+        }
+        manifest = CrawlManifest.from_settings(settings)
+        dedup = DeduplicatePipeline(settings.getint("DEDUP_SIMHASH_DISTANCE", 3), options['dedup_min_length'])
+        dedup.load(manifest)
+        search = SearchIndex(settings.get("SEARCH_INDEX_DIR"), settings.getint("SEARCH_INDEX_SHARDS", 64)) if settings.get("SEARCH_INDEX_DIR") else None
+        output_dir = settings.get("MARKDOWN_OUTPUT_DIR")
+
+        storage = PackedCacheStorage(settings)
+        storage.open(spidercls.name)
+        counts = {'articles': 0, 'written': 0, 'duplicates': 0}
+        entries = (entry for _, *entry in storage.iter_entries() if _is_page(*entry))
+        pool = multiprocessing.get_context('spawn').Pool(opts.workers, reprocess.init, (spidercls, options))
+        try:
+            # bodies are sent to the workers in batches, so the cache is never read into memory at once
+            while batch := list(islice(entries, opts.batch)):
+                for item in pool.imap_unordered(reprocess.process, batch, chunksize=8):
+                    if item is None:
+                        continue
+                    entry = manifest.get(item['url'])
+                    if entry is not None and entry.get('duplicate_of'):
+                        counts['duplicates'] += 1
+                        continue
+                    dedup.collapse(item)
+                    path = f"{output_dir}/{item['path']}/{item['slug']}.md"
+                    Path(path).parent.mkdir(parents=True, exist_ok=True)
+                    if write_atomic(path, _render_markdown(item).encode()) is not None:
+                        counts['written'] += 1
+                    # keep the time the article was last crawled, it decides when it is requested again
+                    seen = {'seen': entry['seen']} if entry is not None else {}
+                    manifest.update(item['url'], item['content_hash'], path, simhash=item.get('simhash'), date=item.get('date'), **seen)
+                    if search is not None:
+                        search.add(*_search_document(item))
+                    counts['articles'] += 1
+        finally:
+            pool.terminate()
+            storage.close()
+        manifest.save()
+        if search is not None:
+            search.save()
+        if settings.get("DEPLOY_MANIFEST_DIR"):
+            DeployManifest.from_settings(settings).write()
+        print(f"Reprocessed {counts['articles']} articles, {counts['written']} changed, {counts['duplicates']} duplicates skipped")
+
+def _is_page(metadata, rawheaders, body):
+    if metadata.get("method", "GET") != "GET" or metadata["status"] != 200:
+        return False
+    return b"text/html" in Headers(headers_raw_to_dict(rawheaders)).get(b"Content-Type", b"").lower()
@@ -0,0 +1,236 @@
+import json
+import multiprocessing
+import re
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+from scrapy.commands import ScrapyCommand
+from scrapy.crawler import CrawlerProcess
+from scrapy.exceptions import UsageError
+from scrapy.settings import SETTINGS_PRIORITIES
+from scrapy.utils.conf import arglist_to_dict
+from scrapy.utils.project import get_project_settings
+
+from ..extensions.deploy import DeployManifest
+from ..extensions.httpcache import PackedCacheStorage
+from ..manifest import CrawlManifest
+from ..dedup import SimHashIndex
+from ..pipelines import DeduplicatePipeline, _DimensionIndex, _JsonIndex
+from ..search import SearchIndex
+from ..writer import write_atomic
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_LEVEL": "WARNING"}
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Crawl with one process per shard of the start urls and merge the output"
+
+    def long_desc(self):
+        return (
+            "Splits the start urls of the spider into N shards, by section or by the hash of the url, and crawls every shard "
+            "in its own process. The shards share the HTTP cache and the image and attachment stores, and export into "
+            "SHARD_DIR/<n> with their own copy of the manifest and the indexes. Once all shards finished, their output, "
+            "manifests, indexes, search documents and stats are merged in shard order, so every run with the same shards "
+            "gives the same result. Articles exported by several shards are deduplicated again across the shards. "
+            "Use --shard to crawl a single shard, e.g. on another machine, and --merge-only to merge the shard directories afterwards."
+        )
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("-n", "--shards", type=int, default=multiprocessing.cpu_count(), help="number of shards (default: one per CPU)")
+        parser.add_argument("--partition", choices=("section", "hash"), default="section", help="assign start urls by section (the default) or by url hash")
+        parser.add_argument("--shard", type=int, action="append", help="only crawl this shard, may be repeated")
+        parser.add_argument("--merge-only", action="store_true", help="merge the shard directories without crawling")
+        parser.add_argument("--no-merge", action="store_true", help="crawl without merging")
+        parser.add_argument("--spider", default="tfls", help="spider to run (default: %(default)s)")
+        parser.add_argument("-a", dest="spargs", action="append", default=[], metavar="NAME=VALUE", help="set spider argument (may be repeated)")
+
+    def process_options(self, args, opts):
+        super().process_options(args, opts)
+        try:
+            opts.spargs = arglist_to_dict(opts.spargs)
+        except ValueError:
+            raise UsageError("Invalid -a value, use -a NAME=VALUE", print_help=False)
+        if opts.shards < 1 or any(not 0 <= shard < opts.shards for shard in opts.shard or ()):
+            raise UsageError("Shards are numbered from 0 to --shards - 1", print_help=False)
+
+    def run(self, args, opts):
+        settings = self.settings
+        shards = [Path(settings.get("SHARD_DIR"), str(shard)) for shard in range(opts.shards)]
+        if not opts.merge_only:
+            # settings given on the command line apply to every shard
+            overrides = {name: value for name, value in settings.items() if settings.getpriority(name) == SETTINGS_PRIORITIES["cmdline"]}
+            # plain processes rather than a Pool: pool workers are daemonic and the pipelines start worker processes of their own
+            processes = {}
+            for shard in opts.shard or range(opts.shards):
+                args = (opts.spider, shard, opts.shards, opts.partition, opts.spargs, {**overrides, **self._prepare(shards[shard])}, shards[shard])
+                processes[shard] = multiprocessing.get_context('spawn').Process(target=_crawl, args=args, name=f"shard-{shard}")
+                processes[shard].start()
+            for shard, process in processes.items():
+                process.join()
+                if process.exitcode != 0:
+                    self.exitcode = 1
+                    print(f"Shard {shard} failed with exit code {process.exitcode}, it is left out of the merge")
+        if not opts.no_merge:
+            self._merge(opts.spider, [shard for shard in shards if (shard / "stats.json").exists()])
+
+    def _prepare(self, directory):
+        settings = self.settings
+        shutil.rmtree(directory, ignore_errors=True)
+        directory.mkdir(parents=True)
+        # every shard starts from the state of the last merged crawl
+        for name in ("MANIFEST_FILE", "IMAGES_INDEX", "FILES_INDEX"):
+            if Path(settings.get(name)).exists():
+                shutil.copy(settings.get(name), directory / Path(settings.get(name)).name)
+        return {
+            "MANIFEST_FILE": str(directory / Path(settings.get("MANIFEST_FILE")).name),
+            "IMAGES_INDEX": str(directory / Path(settings.get("IMAGES_INDEX")).name),
+            "FILES_INDEX": str(directory / Path(settings.get("FILES_INDEX")).name),
+            "MARKDOWN_OUTPUT_DIR": str(directory / "output"),
+            "SEARCH_INDEX_DIR": str(directory / "search") if settings.get("SEARCH_INDEX_DIR") else "",
+            "METRICS_PROMETHEUS_FILE": str(directory / "metrics.prom"),
+            "METRICS_JSON_FILE": str(directory / "metrics.json"),
+            "DEPLOY_MANIFEST_DIR": "",
+            "HTTPCACHE_PACK_SHARED": True,
+        }
+
+    def _merge(self, spider, shards):
+        settings = self.settings
+        output_dir = Path(settings.get("MARKDOWN_OUTPUT_DIR"))
+        manifest = CrawlManifest.from_settings(settings)
+        previous = dict(manifest.entries)
+        images = _DimensionIndex(settings.get("IMAGES_INDEX"))
+        files = _JsonIndex(settings.get("FILES_INDEX"))
+        search = SearchIndex(settings.get("SEARCH_INDEX_DIR"), settings.getint("SEARCH_INDEX_SHARDS", 64)) if settings.get("SEARCH_INDEX_DIR") else None
+        manifests = [CrawlManifest(directory / Path(settings.get("MANIFEST_FILE")).name) for directory in shards]
+        duplicates = self._duplicates(manifests, previous)
+        skipped = {Path(manifest.entries[url]['path']) for manifest in manifests for url in duplicates if url in manifest.entries}
+        written, urls, searched, stats = set(), set(), set(duplicates), []
+
+        # lower shards win wherever two shards exported the same file or url
+        for directory, shard_manifest in zip(shards, manifests):
+            shard_output = directory / "output"
+            for path in sorted(shard_output.rglob("*.md")):
+                relpath = path.relative_to(shard_output)
+                if relpath in written or path in skipped:
+                    continue
+                written.add(relpath)
+                (output_dir / relpath).parent.mkdir(parents=True, exist_ok=True)
+                write_atomic(output_dir / relpath, path.read_bytes())
+
+            for url, entry in sorted(shard_manifest.entries.items()):
+                if url in urls or entry == previous.get(url):
+                    continue
+                urls.add(url)
+                if url in duplicates:
+                    entry = duplicates[url]
+                elif entry.get('duplicate_of') in duplicates:
+                    entry['duplicate_of'] = duplicates[entry['duplicate_of']]['duplicate_of']
+                elif (entry.get('path') or '').startswith(f"{shard_output}/"):
+                    entry['path'] = f"{settings.get('MARKDOWN_OUTPUT_DIR')}/{entry['path'][len(str(shard_output)) + 1:]}"
+                manifest.entries[url] = entry
+
+            shard_images = _DimensionIndex(directory / Path(settings.get("IMAGES_INDEX")).name)
+            for path, entry in shard_images.entries.items():
+                images.entries.setdefault(path, entry)
+            for url, path in shard_images.aliases.items():
+                images.aliases.setdefault(url, path)
+            for url, entry in _JsonIndex(directory / Path(settings.get("FILES_INDEX")).name).entries.items():
+                files.entries.setdefault(url, entry)
+
+            if search is not None and (directory / "search" / "docs.json").exists():
+                searched.update(search.merge(SearchIndex(directory / "search"), skip=searched))
+
+            with open(directory / "stats.json") as f:
+                stats.append(json.load(f))
+
+        if duplicates:
+            dedup = DeduplicatePipeline(settings.getint("DEDUP_SIMHASH_DISTANCE", 3), settings.getint("DEDUP_MIN_LENGTH", 50))
+            dedup.load(manifest)
+            dedup.changed = {entry['duplicate_of'] for entry in duplicates.values()}
+            dedup.patch(manifest)
+        searched.difference_update(duplicates)
+
+        manifest.save()
+        images.save()
+        files.save()
+        if search is not None:
+            search.save()
+        if settings.get("DEPLOY_MANIFEST_DIR"):
+            DeployManifest.from_settings(settings).write()
+        if settings.getbool("HTTPCACHE_ENABLED") and settings.get("HTTPCACHE_STORAGE") == "tfls.extensions.httpcache.PackedCacheStorage":
+            # shards never compact the shared pack
+            storage = PackedCacheStorage(settings)
+            storage.open(spider)
+            storage.close()
+
+        merged = _merge_stats(stats)
+        with open(Path(settings.get("SHARD_DIR"), "stats.json"), "w") as f:
+            json.dump(merged, f, indent=4, sort_keys=True)
+        print(json.dumps(merged, indent=4, sort_keys=True))
+        print(f"Merged {len(shards)} shards: {len(written)} files, {len(urls)} manifest entries, {len(searched)} search documents, "
+              f"{len(duplicates)} duplicates across shards")
+
+    def _duplicates(self, manifests, previous):
+        """Manifest entries of the articles exported by a shard whose text another shard exported first, by url.
+        Every shard only compared its articles with the previous crawl and with each other, like DeduplicatePipeline."""
+        index = SimHashIndex(self.settings.getint("DEDUP_SIMHASH_DISTANCE", 3))
+        exact = {}
+        for url, entry in sorted(previous.items()):
+            if entry.get('path') and not entry.get('duplicate_of'):
+                exact.setdefault(entry['hash'], url)
+                if entry.get('simhash') is not None:
+                    index.add(entry['simhash'], url)
+        duplicates, seen = {}, set()
+        for manifest in manifests:
+            for url, entry in sorted(manifest.entries.items()):
+                if url in seen or not entry.get('path') or entry.get('duplicate_of') or entry == previous.get(url):
+                    continue
+                seen.add(url)
+                canonical = exact.get(entry['hash'])
+                if canonical is None and entry.get('simhash') is not None:
+                    canonical = index.find(entry['simhash'])
+                if canonical is None or canonical == url:
+                    exact.setdefault(entry['hash'], url)
+                    if entry.get('simhash') is not None:
+                        index.add(entry['simhash'], url)
+                    continue
+                front_matter, _ = json.JSONDecoder().raw_decode(Path(entry['path']).read_text())
+                duplicates[url] = {'hash': entry['hash'], 'seen': entry['seen'], 'path': None, 'duplicate_of': canonical,
+                                   'categories': front_matter.get('categories'), 'tags': front_matter.get('tags')}
+        return duplicates
+
+def _crawl(spider, shard, shards, partition, spargs, overrides, directory):
+    settings = get_project_settings()
+    settings.setdict(overrides, priority="cmdline")
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(spider)
+    process.crawl(crawler, shard=shard, shards=shards, partition=partition, **spargs)
+    process.start()
+    # written last, a shard without stats did not finish and is not merged
+    with open(directory / "stats.json", "w") as f:
+        json.dump(crawler.stats.get_stats(), f, indent=4, sort_keys=True, default=lambda value: value.isoformat() if isinstance(value, datetime) else str(value))
+
+# levels and peaks of a single process, merged by their maximum instead of their sum
+_gauges = re.compile(r'^memusage/|(^|/)max_|/max$|/concurrency$')
+
+def _merge_stats(stats):
+    merged = {}
+    for shard in stats:
+        for name, value in shard.items():
+            if name == "start_time":
+                merged[name] = min(merged.get(name, value), value)
+            elif name == "finish_time" or _gauges.search(name):
+                merged[name] = max(merged.get(name, value), value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool) and name != "elapsed_time_seconds":
+                merged[name] = merged.get(name, 0) + value
+            else:
+                merged.setdefault(name, value)
+    if "start_time" in merged and "finish_time" in merged:
+        merged["elapsed_time_seconds"] = (datetime.fromisoformat(merged["finish_time"]) - datetime.fromisoformat(merged["start_time"])).total_seconds()
+    return merged
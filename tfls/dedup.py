@@ -0,0 +1,50 @@
+import re
+from collections import Counter
+from hashlib import blake2b
+from html import unescape
+
+_tags = re.compile(r'<[^>]*>|\s+')
+
+def text_of(html):
+    """Text of an HTML fragment without tags and whitespace, which is all that is compared."""
+    return unescape(_tags.sub('', html))
+
+def simhash(text, size=3):
+    """64 bit SimHash of the character shingles of `text`. Texts sharing most shingles differ in only a few bits."""
+    shingles = {text[i:i + size] for i in range(max(1, len(text) - size + 1))}
+    # count byte values per position first, it is much cheaper than counting all 64 bits of every shingle
+    counts = [Counter() for _ in range(8)]
+    for shingle in shingles:
+        for position, byte in enumerate(blake2b(shingle.encode(), digest_size=8).digest()):
+            counts[position][byte] += 1
+    value = 0
+    for position, counter in enumerate(counts):
+        for bit in range(8):
+            if sum(count for byte, count in counter.items() if byte >> bit & 1) * 2 > len(shingles):
+                value |= 1 << (position * 8 + bit)
+    return value
+
+"""
+Finds SimHashes within `distance` bits of each other. Hashes are split into distance + 1 bands, two hashes within
+the distance share at least one band exactly, so only hashes sharing a band are compared.
+"""
+class SimHashIndex:
+    def __init__(self, distance=3):
+        self.distance = distance
+        self.width = 64 // (distance + 1)
+        self.bands = [{} for _ in range(distance + 1)]
+
+    def _bands(self, value):
+        mask = (1 << self.width) - 1
+        return [(value >> (i * self.width)) & mask for i in range(len(self.bands))]
+
+    def add(self, value, key):
+        for band, part in zip(self.bands, self._bands(value)):
+            band.setdefault(part, []).append((value, key))
+
+    def find(self, value):
+        for band, part in zip(self.bands, self._bands(value)):
+            for candidate, key in band.get(part, ()):
+                if (candidate ^ value).bit_count() <= self.distance:
+                    return key
+        return None
@@ -0,0 +1,89 @@
+import fcntl
+import os
+import threading
+from hashlib import sha1, sha256
+from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+
+"""
+Downloads files with requests on a dedicated thread pool, streaming bodies to disk in chunks so large files never sit in memory.
+Interrupted downloads are kept as `.part` files and resumed with Range requests. Finished files are stored under their sha256.
+`.part` files are locked while written, so several processes can share the store.
+"""
+class StreamingDownloader:
+    def __init__(self, store, threads=2, chunk_size=1 << 16, timeout=180, headers=None):
+        self.store = Path(store)
+        self.threadpool = ThreadPool(1, threads, name=self.__class__.__name__)
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.local = threading.local()
+
+    def start(self):
+        self.threadpool.start()
+
+    def stop(self):
+        self.threadpool.stop()
+
+    def download(self, url):
+        from twisted.internet import reactor
+
+        return threads.deferToThreadPool(reactor, self.threadpool, self._download, url)
+
+    def _session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+            self.local.session.headers.update(self.headers)
+        return self.local.session
+
+    def _download(self, url):
+        partial = Path(self.store, "partial", f"{sha1(url.encode()).hexdigest()}.part")
+        partial.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock(partial) as f:
+            offset = os.fstat(f.fileno()).st_size
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            with self._session().get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                if response.status_code == 416 and response.headers.get('Content-Range') == f'bytes */{offset}':
+                    pass  # the partial file is already complete
+                elif response.status_code in (200, 206):
+                    # servers ignoring the Range header send the whole file again
+                    if response.status_code == 200:
+                        f.truncate(0)
+                    for chunk in response.iter_content(self.chunk_size):
+                        f.write(chunk)
+                    f.flush()
+                else:
+                    if response.status_code == 416:
+                        partial.unlink()
+                    response.raise_for_status()
+                    raise requests.HTTPError(f"Unexpected status {response.status_code} for {url}", response=response)
+            checksum = self._checksum(partial)
+            path = f"{checksum[:2]}/{checksum}{Path(urlparse(url).path).suffix.lower()}"
+            target = Path(self.store, path)
+            if target.exists():
+                partial.unlink()
+            else:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(partial, target)
+        return {'url': url, 'path': path, 'checksum': checksum, 'size': target.stat().st_size}
+
+    def _lock(self, partial):
+        """Opens `partial` for appending and locks it, so processes sharing the store never write the same download at once."""
+        while True:
+            f = open(partial, 'ab')
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            # the holder of the lock may have finished the download and moved the file away meanwhile
+            if partial.exists() and os.stat(partial).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+            f.close()
+
+    def _checksum(self, path):
+        digest = sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(self.chunk_size):
+                digest.update(chunk)
+        return digest.hexdigest()
@@ -0,0 +1,230 @@
+import logging
+import os
+import pickle
+from contextlib import suppress
+from pathlib import Path
+from time import time
+
+from itemadapter import is_item
+from scrapy import signals
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.exceptions import NotConfigured
+from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.utils.job import job_dir
+from scrapy.utils.request import RequestFingerprinter, request_from_dict
+
+logger = logging.getLogger(__name__)
+
+"""
+A set of fixed-size binary fingerprints kept as one sorted byte string plus a small set of recent additions.
+It takes 20 bytes per fingerprint instead of the ~100 bytes of a set of hex strings, and lookups are exact.
+"""
+class FingerprintSet:
+    SIZE = 20
+
+    def __init__(self, data=b'', merge_threshold=10000):
+        self.data = data
+        self.recent = set()
+        self.merge_threshold = merge_threshold
+
+    def __len__(self):
+        return len(self.data) // self.SIZE + len(self.recent)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.recent or self._search(fingerprint)
+
+    def add(self, fingerprint):
+        self.recent.add(fingerprint)
+        if len(self.recent) >= self.merge_threshold:
+            self.merge()
+
+    def merge(self):
+        if self.recent:
+            chunks = [self.data[i:i + self.SIZE] for i in range(0, len(self.data), self.SIZE)]
+            self.data = b''.join(sorted(chunks + list(self.recent)))
+            self.recent = set()
+
+    def _search(self, fingerprint):
+        low, high = 0, len(self.data) // self.SIZE
+        while low < high:
+            middle = (low + high) // 2
+            value = self.data[middle * self.SIZE:(middle + 1) * self.SIZE]
+            if value == fingerprint:
+                return True
+            if value < fingerprint:
+                low = middle + 1
+            else:
+                high = middle
+        return False
+
+    @classmethod
+    def load(cls, path):
+        return cls(Path(path).read_bytes() if Path(path).exists() else b'')
+
+    def save(self, path):
+        self.merge()
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.data)
+        os.replace(tmp, path)
+
+"""
+Duplicates filter keeping request fingerprints in a FingerprintSet. With a JOBDIR the set is flushed to disk
+every DUPEFILTER_FLUSH_INTERVAL seconds and when the spider closes, so a resumed crawl skips everything seen before.
+"""
+class CompactDupeFilter(RFPDupeFilter):
+    def __init__(self, path=None, debug=False, *, fingerprinter=None, flush_interval=60):
+        self.fingerprinter = fingerprinter or RequestFingerprinter()
+        self.logdupes = True
+        self.debug = debug
+        self.logger = logging.getLogger(__name__)
+        self.path = Path(path, "requests.seen.bin") if path else None
+        self.fingerprints = FingerprintSet.load(self.path) if self.path else FingerprintSet()
+        self.flush_interval = flush_interval
+        self.flushed = time()
+
+    @classmethod
+    def from_settings(cls, settings, *, fingerprinter=None):
+        return cls(
+            job_dir(settings),
+            settings.getbool("DUPEFILTER_DEBUG"),
+            fingerprinter=fingerprinter,
+            flush_interval=settings.getfloat("DUPEFILTER_FLUSH_INTERVAL", 60),
+        )
+
+    def request_seen(self, request):
+        fingerprint = self.fingerprinter.fingerprint(request)
+        if fingerprint in self.fingerprints:
+            return True
+        self.fingerprints.add(fingerprint)
+        if self.path and time() - self.flushed > self.flush_interval:
+            self.flush()
+        return False
+
+    def flush(self):
+        self.fingerprints.save(self.path)
+        self.flushed = time()
+
+    def close(self, reason):
+        if self.path:
+            self.flush()
+
+"""
+With a JOBDIR, journals every request taken from the scheduler in JOBDIR/requests.inflight until its response was parsed and
+all items it produced were scraped or dropped, or until its download failed. The scheduler and the duplicates filter consider
+a request done once it is dequeued, so requests still open when the crawl stopped, and requests whose items failed in a pipeline,
+are scheduled again when the job is resumed. Registered both as downloader and as spider middleware, sharing one journal.
+"""
+class ResumeInflightMiddleware:
+    def __init__(self, crawler, path):
+        self.crawler = crawler
+        self.path = Path(path, "requests.inflight")
+        self.fingerprinter = crawler.request_fingerprinter
+        self.inflight = {}
+        self.journal = None
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(self.item_done, signal=signals.item_scraped)
+        crawler.signals.connect(self.item_done, signal=signals.item_dropped)
+        crawler.signals.connect(self.item_error, signal=signals.item_error)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = job_dir(crawler.settings)
+        if not path:
+            raise NotConfigured
+        if not hasattr(crawler, "resume_inflight"):
+            crawler.resume_inflight = cls(crawler, path)
+        return crawler.resume_inflight
+
+    def spider_opened(self, spider):
+        pending = {}
+        if self.path.exists():
+            with open(self.path, "rb") as f:
+                # the last record may be cut short if the crawl was killed
+                with suppress(EOFError, pickle.UnpicklingError):
+                    while True:
+                        fingerprint, request = pickle.load(f)
+                        if request is None:
+                            pending.pop(fingerprint, None)
+                        else:
+                            pending[fingerprint] = request
+        self.journal = open(self.path, "wb")
+        for request in pending.values():
+            self.crawler.engine.crawl(request_from_dict(request, spider=spider).replace(dont_filter=True))
+        if pending:
+            logger.info(f"Scheduled {len(pending)} requests again which were in flight when the job stopped")
+
+    def spider_closed(self, spider):
+        self.journal.close()
+
+    def _write(self, fingerprint, request):
+        try:
+            record = pickle.dumps((fingerprint, request))
+        except Exception:
+            return False
+        self.journal.write(record)
+        self.journal.flush()
+        return True
+
+    def _done(self, fingerprint):
+        entry = self.inflight.pop(fingerprint, None)
+        if entry is not None and not entry['failed']:
+            self._write(fingerprint, None)
+
+    def _settle(self, fingerprint):
+        entry = self.inflight.get(fingerprint)
+        if entry is None or not entry['parsed'] or entry['items']:
+            return
+        if entry['failed']:
+            # left open in the journal, the request is scheduled again on resume
+            del self.inflight[fingerprint]
+        else:
+            self._done(fingerprint)
+
+    def process_request(self, request, spider):
+        # redirects and retries carry the fingerprint of the journaled request in their meta, revalidations of cached
+        # responses already served are not worth resuming
+        if "inflight" in request.meta or request.meta.get("revalidate"):
+            return
+        fingerprint = self.fingerprinter.fingerprint(request).hex()
+        if self._write(fingerprint, request.to_dict(spider=spider)):
+            request.meta["inflight"] = fingerprint
+            self.inflight[fingerprint] = {'parsed': False, 'items': 0, 'failed': False}
+
+    def process_exception(self, request, exception, spider):
+        if "inflight" in request.meta:
+            self._done(request.meta["inflight"])
+
+    def process_spider_output(self, response, result, spider):
+        fingerprint = response.meta.get("inflight")
+        entry = self.inflight.get(fingerprint)
+        for output in result:
+            if entry is not None and is_item(output):
+                entry['items'] += 1
+            yield output
+        if entry is not None:
+            entry['parsed'] = True
+            self._settle(fingerprint)
+
+    def process_spider_exception(self, response, exception, spider):
+        # responses rejected before the callback, e.g. by HttpErrorMiddleware, are done
+        if isinstance(exception, HttpError) and "inflight" in response.meta:
+            self._done(response.meta["inflight"])
+
+    def _entry(self, response):
+        fingerprint = response.meta.get("inflight") if response is not None and response.request is not None else None
+        return fingerprint, self.inflight.get(fingerprint)
+
+    def item_done(self, item, response, spider, **kwargs):
+        fingerprint, entry = self._entry(response)
+        if entry is not None:
+            entry['items'] -= 1
+            self._settle(fingerprint)
+
+    def item_error(self, item, response, spider, failure):
+        fingerprint, entry = self._entry(response)
+        if entry is not None:
+            entry['items'] -= 1
+            entry['failed'] = True
+            self._settle(fingerprint)
@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+from datetime import datetime
+from hashlib import sha1
+from pathlib import Path
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import threads
+
+logger = logging.getLogger(__name__)
+
+def _hash(path):
+    digest = sha1()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 16):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def scan(root, previous=None):
+    """Lists the files under `root` with their hash, size and mtime. Hashes of files whose size and mtime did not change are taken from `previous`."""
+    previous = previous or {}
+    files = {}
+    for path in sorted(Path(root).rglob('*')):
+        relpath = path.relative_to(root).as_posix()
+        # temporary and partially downloaded files are never deployed
+        if not path.is_file() or path.name.endswith(('.tmp', '.part')) or relpath.startswith('partial/'):
+            continue
+        stat = path.stat()
+        entry = previous.get(relpath)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            entry = {'hash': _hash(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        files[relpath] = entry
+    return files
+
+def diff(previous, current):
+    return {
+        'added': {path: entry['hash'] for path, entry in current.items() if path not in previous},
+        'modified': {path: entry['hash'] for path, entry in current.items() if path in previous and previous[path]['hash'] != entry['hash']},
+        'deleted': sorted(path for path in previous if path not in current),
+    }
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def _dump(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=4, sort_keys=True)
+    os.replace(tmp, path)
+
+"""
+When the spider closes, lists every file of the DEPLOY_TREES with its content hash in DEPLOY_MANIFEST_DIR/files.json,
+and writes the files added, modified and deleted since the previous listing to DEPLOY_MANIFEST_DIR/run-<time>.json.
+`scrapy deploydiff` turns run manifests into the files to upload and delete.
+"""
+class DeployManifest:
+    def __init__(self, directory, trees):
+        self.directory = Path(directory)
+        self.trees = trees
+
+    @classmethod
+    def from_settings(cls, settings):
+        if not settings.get("DEPLOY_MANIFEST_DIR"):
+            raise NotConfigured
+        trees = {name: settings.get(setting) for name, setting in settings.getdict("DEPLOY_TREES").items() if settings.get(setting)}
+        return cls(settings.get("DEPLOY_MANIFEST_DIR"), trees)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = cls.from_settings(crawler.settings)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def spider_closed(self, spider, reason):
+        return threads.deferToThread(self.write)
+
+    def write(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        listing = self.directory / "files.json"
+        previous = load(listing)['trees'] if listing.exists() else {}
+        created = datetime.now().strftime("%Y%m%dT%H%M%S")
+        current, changes = {}, {}
+        for name, root in sorted(self.trees.items()):
+            before = previous.get(name, {}).get('files', {})
+            current[name] = {'root': root, 'files': scan(root, before) if Path(root).exists() else {}}
+            changes[name] = {'root': root, **diff(before, current[name]['files'])}
+        run = self.directory / f"run-{created}.json"
+        _dump(run, {'created': created, 'trees': changes})
+        _dump(listing, {'created': created, 'trees': current})
+        changed = sum(len(c['added']) + len(c['modified']) + len(c['deleted']) for c in changes.values())
+        logger.info(f"Wrote deploy manifest {run} with {changed} changed files")
+        return run
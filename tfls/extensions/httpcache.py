@@ -1,16 +1,31 @@
+import fcntl
+import json
 import logging
-from email.utils import mktime_tz, parsedate_tz
+import mmap
+import os
+import re
+import sqlite3
+import struct
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from pathlib import Path
 from time import time
 from weakref import WeakKeyDictionary
 
-from scrapy.http import Response
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import Headers, Response
+from scrapy.responsetypes import responsetypes
 from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.project import data_path
 from scrapy.utils.python import to_bytes, to_unicode
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
 
 logger = logging.getLogger(__name__)
 
 """
-This modified policy will cache all urls with '/' ending for up to a day, and the rest for up to a month if no RFC2616 defined caching rules can be found.
+If no RFC2616 defined caching rules can be found, this modified policy caches urls for the lifetime of the first HTTPCACHE_FRESHNESS_RULES pattern they match, and for HTTPCACHE_FRESHNESS_DEFAULT otherwise.
+Stale responses stay usable for another HTTPCACHE_STALE_WHILE_REVALIDATE seconds while they are revalidated in the background.
+Requests with `refresh` in their meta are always downloaded again, their responses are still stored.
 """
 class ModifiedRFC2616Policy:
     MAXAGE = 3600 * 24 * 31  # one month
@@ -23,6 +38,12 @@ class ModifiedRFC2616Policy:
             to_bytes(cc)
             for cc in settings.getlist("HTTPCACHE_IGNORE_RESPONSE_CACHE_CONTROLS")
         ]
+        self.freshness_rules = [
+            (re.compile(pattern), int(lifetime))
+            for pattern, lifetime in settings.getdict("HTTPCACHE_FRESHNESS_RULES").items()
+        ]
+        self.default_freshness = settings.getint("HTTPCACHE_FRESHNESS_DEFAULT", self.MAXAGE)
+        self.stale_while_revalidate = settings.getint("HTTPCACHE_STALE_WHILE_REVALIDATE")
 
     def _parse_cachecontrol(self, r):
         if r not in self._cc_parsed:
@@ -59,6 +80,8 @@ class ModifiedRFC2616Policy:
         return False
 
     def is_cached_response_fresh(self, cachedresponse, request):
+        if request.meta.get("refresh"):
+            return False
         cc = self._parse_cachecontrol(cachedresponse)
         ccreq = self._parse_cachecontrol(request)
         if b"no-cache" in cc or b"no-cache" in ccreq:
@@ -91,6 +114,21 @@ class ModifiedRFC2616Policy:
         self._set_conditional_validators(request, cachedresponse)
         return False
 
+    def is_cached_response_usable(self, cachedresponse, request):
+        """Whether a stale response may still be served while it is revalidated."""
+        if request.meta.get("refresh"):
+            return False
+        cc = self._parse_cachecontrol(cachedresponse)
+        if b"must-revalidate" in cc:
+            return False
+        try:
+            window = int(cc[b"stale-while-revalidate"])
+        except (KeyError, TypeError, ValueError):
+            window = self.stale_while_revalidate
+        now = time()
+        freshnesslifetime = self._compute_freshness_lifetime(cachedresponse, request, now)
+        return self._compute_current_age(cachedresponse, request, now) < freshnesslifetime + window
+
     def is_cached_response_valid(self, cachedresponse, response, request):
         if response.status >= 500:
             cc = self._parse_cachecontrol(cachedresponse)
@@ -126,22 +164,14 @@ class ModifiedRFC2616Policy:
             expires = rfc1123_to_epoch(response.headers[b"Expires"])
             return max(0, expires - date) if expires else 0
 
-        if response.url.endswith('/'):
-            return 3600 * 24
-        else:
-            return 3600 * 24 * 31
-
-        #lastmodified = rfc1123_to_epoch(response.headers.get(b"Last-Modified"))
-        #if lastmodified and lastmodified <= date:
-        #    return (date - lastmodified) / 10
-
-        if response.status in (300, 301, 308):
-            return self.MAXAGE
-
-        return 0
+        for pattern, lifetime in self.freshness_rules:
+            if pattern.search(response.url):
+                return lifetime
+        return self.default_freshness
 
     def _compute_current_age(self, response, request, now):
         date = rfc1123_to_epoch(response.headers.get(b"Date")) or now
+        currentage = 0
         if now > date:
             currentage = now - date
 
@@ -154,6 +184,192 @@ class ModifiedRFC2616Policy:
 
         return currentage
 
+"""
+Serves stale cached responses right away when the policy allows it, and revalidates them with a conditional request at low priority.
+Revalidated responses are stored with a fresh Date, changed ones are passed on to the spider.
+"""
+class StaleWhileRevalidateMiddleware(HttpCacheMiddleware):
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = super().from_crawler(crawler)
+        o.crawler = crawler
+        o.revalidate_priority = crawler.settings.getint("HTTPCACHE_REVALIDATE_PRIORITY")
+        return o
+
+    def process_request(self, request, spider):
+        response = super().process_request(request, spider)
+        cachedresponse = request.meta.get("cached_response")
+        if request.meta.get("revalidate") or cachedresponse is None:
+            return response
+        if self.policy.is_cached_response_usable(cachedresponse, request):
+            del request.meta["cached_response"]
+            self.stats.inc_value("httpcache/stale", spider=spider)
+            self.crawler.engine.crawl(request.replace(
+                priority=self.revalidate_priority,
+                dont_filter=True,
+                meta={**request.meta, "revalidate": True},
+            ))
+            return cachedresponse
+        return response
+
+    def process_response(self, request, response, spider):
+        cachedresponse = request.meta.get("cached_response")
+        result = super().process_response(request, response, spider)
+        if cachedresponse is not None and result is cachedresponse and response.status == 304:
+            cachedresponse.headers[b"Date"] = formatdate(usegmt=True)
+            self.storage.store_response(spider, request, cachedresponse)
+        if request.meta.get("revalidate") and "cached" in result.flags:
+            raise IgnoreRequest(f"Revalidated {request}")
+        return result
+
+    def process_exception(self, request, exception, spider):
+        if request.meta.get("revalidate"):
+            request.meta.pop("cached_response", None)
+            raise IgnoreRequest(f"Revalidation failed for {request}: {exception}")
+        return super().process_exception(request, exception, spider)
+
+"""
+This storage keeps all cached responses of a spider in a single append-only pack file, indexed by request fingerprint in SQLite.
+Entries are read through mmap, superseded entries are dropped by compaction once they take up more than HTTPCACHE_PACK_COMPACT_RATIO of the pack.
+With HTTPCACHE_PACK_SHARED several processes can use the same pack: appends are serialized with a file lock, every entry is committed
+right away and the pack is never compacted on close.
+"""
+class PackedCacheStorage:
+    _record = struct.Struct(">III")
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings["HTTPCACHE_DIR"], createdir=True)
+        self.expiration_secs = settings.getint("HTTPCACHE_EXPIRATION_SECS")
+        self.compact_ratio = settings.getfloat("HTTPCACHE_PACK_COMPACT_RATIO", 0.5)
+        self.shared = settings.getbool("HTTPCACHE_PACK_SHARED")
+        self._pending = 0
+
+    def open_spider(self, spider):
+        self.open(spider.name)
+        self._fingerprinter = spider.crawler.request_fingerprinter
+
+    def close_spider(self, spider):
+        self.close()
+
+    def open(self, name):
+        self.packpath = Path(self.cachedir, f"{name}.pack")
+        self.db = sqlite3.connect(Path(self.cachedir, f"{name}.sqlite"), timeout=60)
+        if self.shared:
+            self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (fingerprint TEXT PRIMARY KEY, offset INTEGER, length INTEGER, timestamp REAL)")
+        self.pack = open(self.packpath, "ab")
+        self._map = None
+        logger.debug(f"Using packed cache storage in {self.packpath}")
+
+    def close(self):
+        self.db.commit()
+        live, = self.db.execute("SELECT COALESCE(SUM(length), 0) FROM entries").fetchone()
+        size = self.pack.tell()
+        if size and (size - live) / size > self.compact_ratio and not self.shared:
+            self.compact()
+        self._unmap()
+        self.pack.close()
+        self.db.close()
+
+    def retrieve_response(self, spider, request):
+        """Return response if present in cache, or None otherwise."""
+        entry = self.db.execute(
+            "SELECT offset, length, timestamp FROM entries WHERE fingerprint = ?",
+            (self._fingerprinter.fingerprint(request).hex(),),
+        ).fetchone()
+        if entry is None:
+            return  # not cached
+        offset, length, timestamp = entry
+        if 0 < self.expiration_secs < time() - timestamp:
+            return  # expired
+        metadata, rawheaders, body = self._read(offset, length)
+        url = metadata.get("response_url")
+        headers = Headers(headers_raw_to_dict(rawheaders))
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=metadata["status"], body=body)
+
+    def store_response(self, spider, request, response):
+        """Store the given response in the cache."""
+        metadata = {
+            "url": request.url,
+            "method": request.method,
+            "status": response.status,
+            "response_url": response.url,
+            "timestamp": time(),
+        }
+        self.append(self._fingerprinter.fingerprint(request).hex(), metadata, headers_dict_to_raw(response.headers), response.body)
+
+    def append(self, fingerprint, metadata, rawheaders, body):
+        meta = json.dumps(metadata).encode()
+        if self.shared:
+            fcntl.flock(self.pack.fileno(), fcntl.LOCK_EX)
+            # other processes may have appended since the last write
+            self.pack.seek(0, os.SEEK_END)
+        try:
+            offset = self.pack.tell()
+            self.pack.write(self._record.pack(len(meta), len(rawheaders), len(body)))
+            self.pack.write(meta)
+            self.pack.write(rawheaders)
+            self.pack.write(body)
+            self.pack.flush()
+            length = self.pack.tell() - offset
+        finally:
+            if self.shared:
+                fcntl.flock(self.pack.fileno(), fcntl.LOCK_UN)
+        self.db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+            (fingerprint, offset, length, metadata["timestamp"]),
+        )
+        self._pending += 1
+        if self._pending >= 100 or self.shared:
+            self.db.commit()
+            self._pending = 0
+
+    def iter_entries(self):
+        """Yield (fingerprint, metadata, rawheaders, body) of all cached responses in pack order."""
+        for fingerprint, offset, length in self.db.execute("SELECT fingerprint, offset, length FROM entries ORDER BY offset").fetchall():
+            yield (fingerprint, *self._read(offset, length))
+
+    def compact(self):
+        """Rewrite the pack with live entries only."""
+        self.db.commit()
+        tmppath = self.packpath.with_suffix(".pack.tmp")
+        offsets = []
+        with open(tmppath, "wb") as f:
+            for fingerprint, offset, length in self.db.execute("SELECT fingerprint, offset, length FROM entries ORDER BY offset").fetchall():
+                offsets.append((f.tell(), fingerprint))
+                with self._slice(offset, length) as record:
+                    f.write(record)
+        self._unmap()
+        self.pack.close()
+        os.replace(tmppath, self.packpath)
+        with self.db:
+            self.db.executemany("UPDATE entries SET offset = ? WHERE fingerprint = ?", offsets)
+        self.pack = open(self.packpath, "ab")
+        logger.info(f"Compacted {self.packpath} to {len(offsets)} entries")
+
+    def _read(self, offset, length):
+        with self._slice(offset, length) as record:
+            metalen, headerslen, bodylen = self._record.unpack_from(record)
+            start = self._record.size
+            metadata = json.loads(bytes(record[start:start + metalen]))
+            start += metalen
+            rawheaders = bytes(record[start:start + headerslen])
+            start += headerslen
+            return metadata, rawheaders, bytes(record[start:start + bodylen])
+
+    def _slice(self, offset, length):
+        if self._map is None or offset + length > len(self._map):
+            self._unmap()
+            with open(self.packpath, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)[offset:offset + length]
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
 def parse_cachecontrol(header):
     directives = {}
     for directive in header.split(b","):
@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import re
+from bisect import bisect_left
+from functools import wraps
+from pathlib import Path
+from time import perf_counter
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import defer, task
+
+logger = logging.getLogger(__name__)
+
+# sent with stage and seconds whenever a timed stage finishes
+stage_timed = object()
+
+def timed(stage):
+    """Report the wall time of a middleware or pipeline method taking `spider` as its last argument. Deferred results are timed until they fire."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            spider = kwargs['spider'] if 'spider' in kwargs else args[-1]
+            start = perf_counter()
+            try:
+                result = method(self, *args, **kwargs)
+            except Exception:
+                _report(spider, stage, start)
+                raise
+            if isinstance(result, defer.Deferred):
+                result.addBoth(lambda r: _report(spider, stage, start) or r)
+            else:
+                _report(spider, stage, start)
+            return result
+        return wrapper
+    return decorator
+
+def _report(spider, stage, start):
+    crawler = getattr(spider, 'crawler', None)
+    if crawler is not None:
+        crawler.signals.send_catch_log(stage_timed, stage=stage, seconds=perf_counter() - start)
+
+class Histogram:
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.sum = 0
+        self.count = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile."""
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'max': self.max,
+        }
+
+"""
+Keeps histograms of download latency per url class and of the time spent in each timed stage, plus gauges of the crawl queues.
+They are written to METRICS_PROMETHEUS_FILE in Prometheus text format every METRICS_INTERVAL seconds, and to METRICS_JSON_FILE when the spider closes.
+"""
+class StageMetrics:
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool("METRICS_ENABLED"):
+            raise NotConfigured
+        self.crawler = crawler
+        self.interval = settings.getfloat("METRICS_INTERVAL")
+        self.prometheus_file = settings.get("METRICS_PROMETHEUS_FILE")
+        self.json_file = settings.get("METRICS_JSON_FILE")
+        self.url_classes = [(name, re.compile(pattern)) for name, pattern in settings.getdict("METRICS_URL_CLASSES").items()]
+        self.stages = {}
+        self.downloads = {}
+        self.queues = {}
+        self.queues_max = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = cls(crawler)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(o.response_received, signal=signals.response_received)
+        crawler.signals.connect(o.stage_timed, signal=stage_timed)
+        return o
+
+    def spider_opened(self, spider):
+        self.task = task.LoopingCall(self.export)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task.running:
+            self.task.stop()
+        self.export()
+        summary = {
+            'stages': {name: h.summary() for name, h in sorted(self.stages.items())},
+            'downloads': {name: h.summary() for name, h in sorted(self.downloads.items())},
+            'queues': {name: {'last': self.queues[name], 'max': self.queues_max[name]} for name in sorted(self.queues)},
+        }
+        _write(self.json_file, json.dumps(summary, indent=4))
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None and 'cached' not in response.flags:
+            self.downloads.setdefault(self._url_class(request.url), Histogram()).observe(latency)
+
+    def stage_timed(self, stage, seconds):
+        self.stages.setdefault(stage, Histogram()).observe(seconds)
+
+    def _url_class(self, url):
+        for name, pattern in self.url_classes:
+            if pattern.search(url):
+                return name
+        return 'other'
+
+    def _sample_queues(self):
+        engine = self.crawler.engine
+        if engine is None or engine.slot is None:
+            return
+        gauges = {
+            'scheduler': len(engine.slot.scheduler),
+            'downloader': len(engine.downloader.active),
+            'scraper': len(engine.scraper.slot.active) if engine.scraper.slot else 0,
+        }
+        for pipeline in engine.scraper.itemproc.middlewares:
+            for name in ('pool', 'writer'):
+                if hasattr(pipeline, name):
+                    gauges[f"{pipeline.__class__.__name__}.{name}"] = getattr(pipeline, name).pending
+        for name, value in gauges.items():
+            self.queues[name] = value
+            self.queues_max[name] = max(value, self.queues_max.get(name, 0))
+
+    def export(self):
+        self._sample_queues()
+        lines = []
+        for metric, label, histograms in (('tfls_stage_seconds', 'stage', self.stages), ('tfls_download_seconds', 'url_class', self.downloads)):
+            lines.append(f"# TYPE {metric} histogram")
+            for name, h in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(h.BUCKETS, h.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append(f'{metric}_bucket{{{label}="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {h.sum}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {h.count}')
+        lines.append("# TYPE tfls_queue_depth gauge")
+        for name, value in sorted(self.queues.items()):
+            lines.append(f'tfls_queue_depth{{queue="{name}"}} {value}')
+        _write(self.prometheus_file, '\n'.join(lines) + '\n')
+
+def _write(path, data):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(data)
+    os.replace(tmp, path)
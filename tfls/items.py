@@ -8,6 +8,8 @@ import scrapy
 class PageItem(scrapy.Item):
     image_urls = scrapy.Field()
     images = scrapy.Field()
+    file_urls = scrapy.Field()
+    files = scrapy.Field()
     description = scrapy.Field()
     tags = scrapy.Field()
     date = scrapy.Field()
@@ -16,6 +18,10 @@ class PageItem(scrapy.Item):
     slug = scrapy.Field()
     title = scrapy.Field()
     content = scrapy.Field()
+    content_file = scrapy.Field()
     categories = scrapy.Field()
     path = scrapy.Field()
-    weight = scrapy.Field()
\ No newline at end of file
+    weight = scrapy.Field()
+    content_hash = scrapy.Field()
+    simhash = scrapy.Field()
+    aliases = scrapy.Field()
\ No newline at end of file
@@ -0,0 +1,60 @@
+import json
+import logging
+import os
+from hashlib import sha1
+from pathlib import Path
+from time import time
+
+logger = logging.getLogger(__name__)
+
+def content_hash(content):
+    return sha1(content.encode()).hexdigest()
+
+"""
+The crawl manifest maps every exported url to the hash of its extracted content, the time it was last seen and the path it was exported to.
+It lets the spider stop paging through listings once it reaches known articles, and the pipelines skip items whose content did not change.
+"""
+class CrawlManifest:
+    def __init__(self, path, max_age=30, flush_interval=60):
+        self.path = Path(path)
+        self.max_age = max_age * 3600 * 24
+        self.flush_interval = flush_interval
+        self.flushed = time()
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.entries = json.load(f)
+            logger.info(f"Loaded {len(self.entries)} manifest entries from {self.path}")
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get("MANIFEST_FILE"), settings.getfloat("MANIFEST_MAX_AGE"), settings.getfloat("MANIFEST_FLUSH_INTERVAL", 60))
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    def is_known(self, url):
+        entry = self.entries.get(url)
+        return entry is not None and time() - entry['seen'] < self.max_age
+
+    def is_unchanged(self, url, hash):
+        entry = self.entries.get(url)
+        return entry is not None and entry['hash'] == hash
+
+    def touch(self, url):
+        if url in self.entries:
+            self.entries[url]['seen'] = time()
+
+    def update(self, url, hash, path, **extra):
+        self.entries[url] = {'hash': hash, 'seen': time(), 'path': path, **extra}
+        # flushed periodically so an interrupted crawl does not export the same items again
+        if time() - self.flushed > self.flush_interval:
+            self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, ensure_ascii=False, sort_keys=True)
+        os.replace(tmp, self.path)
+        self.flushed = time()
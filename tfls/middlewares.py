@@ -3,17 +3,247 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
-import lxml
-from lxml.etree import tostring
+import logging
+from collections import deque
+from time import time
+
+import lxml.html
+from lxml.etree import XPath
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import HtmlResponse
+from scrapy.selector import Selector
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet.defer import CancelledError
+from twisted.internet.task import LoopingCall, deferLater
+
+from .extensions.metrics import timed
+
+logger = logging.getLogger(__name__)
+
+_parsers = {}
+_images = XPath('//img')
+_attachments = XPath('//a[@class="ke-insertfile"]')
+
+"""
+Html response whose selector wraps a tree parsed, and possibly rewritten, before the response reached the spider.
+Only the selector sees the tree: `body` and `text` stay as downloaded. Copies made with `replace()` parse their body again.
+"""
+class ParsedHtmlResponse(HtmlResponse):
+    def __init__(self, *args, root=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._parsed_selector = Selector(root=root, type='html') if root is not None else None
+
+    @property
+    def selector(self):
+        return self._parsed_selector if self._parsed_selector is not None else super().selector
 
 class AbsoluteUrlMiddleware:
+    @timed("absolute_urls")
     def process_response(self, request, response, spider):
         if response.status == 200 and 'text/html' in str(response.headers.get("content-type", "").lower()):
-            body_lxml = lxml.html.document_fromstring(response.body)
-            for img in body_lxml.xpath('//img'):
+            if response.encoding not in _parsers:
+                _parsers[response.encoding] = lxml.html.HTMLParser(encoding=response.encoding)
+            body_lxml = lxml.html.document_fromstring(response.body, parser=_parsers[response.encoding])
+            for img in _images(body_lxml):
                 img.set('src',response.urljoin(img.get('src')))
-            for attachment in body_lxml.xpath('//a[@class="ke-insertfile"]'):
+            for attachment in _attachments(body_lxml):
                 attachment.set('href',response.urljoin(attachment.get('href')))
-            return response.replace(body=tostring(body_lxml))
+            # hand the rewritten tree to the spider instead of serializing it and parsing it again
+            return response.replace(cls=ParsedHtmlResponse, root=body_lxml)
         else:
             return response
+
+class _OriginHealth:
+    def __init__(self, window, concurrency, retry_tokens):
+        self.samples = deque(maxlen=window)
+        self.concurrency = concurrency
+        self.state = 'closed'
+        self.opened_at = 0
+        self.cooldown = 0
+        self.probing = False
+        self.retry_tokens = retry_tokens
+        self.since_adjusted = 0
+
+    @property
+    def healthy(self):
+        return self.state == 'closed'
+
+    def error_rate(self):
+        return sum(not ok for _, ok in self.samples) / len(self.samples) if self.samples else 0
+
+    def latency(self):
+        latencies = [latency for latency, ok in self.samples if ok and latency is not None]
+        return sum(latencies) / len(latencies) if latencies else 0
+
+"""
+Tracks the rolling latency and error rate of every host and adapts the downloader slot concurrency to keep the latency
+under ORIGIN_HEALTH_LATENCY_TARGET, decreasing it multiplicatively and increasing it one request at a time.
+When the error rate exceeds ORIGIN_HEALTH_ERROR_THRESHOLD the circuit opens: requests wait for ORIGIN_HEALTH_COOLDOWN seconds,
+then a single probe decides whether to close it again or to double the cooldown. While a host is unhealthy, requests with an
+expired cached response are answered from the cache and background revalidations are dropped.
+Retries draw from a budget refilled by ORIGIN_HEALTH_RETRY_BUDGET tokens per successful response, so a failing server is not hit by retry storms.
+Requests still waiting when the spider starts closing are dropped, so a paused host does not hold up the shutdown.
+"""
+class OriginHealthMiddleware:
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool("ORIGIN_HEALTH_ENABLED"):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.window = settings.getint("ORIGIN_HEALTH_WINDOW", 50)
+        self.latency_target = settings.getfloat("ORIGIN_HEALTH_LATENCY_TARGET", 5)
+        self.min_concurrency = settings.getint("ORIGIN_HEALTH_MIN_CONCURRENCY", 1)
+        self.max_concurrency = settings.getint("ORIGIN_HEALTH_MAX_CONCURRENCY", settings.getint("CONCURRENT_REQUESTS"))
+        self.error_threshold = settings.getfloat("ORIGIN_HEALTH_ERROR_THRESHOLD", 0.5)
+        self.cooldown = settings.getfloat("ORIGIN_HEALTH_COOLDOWN", 30)
+        self.max_cooldown = settings.getfloat("ORIGIN_HEALTH_MAX_COOLDOWN", 600)
+        self.retry_budget = settings.getfloat("ORIGIN_HEALTH_RETRY_BUDGET", 0.2)
+        self.retry_budget_max = settings.getfloat("ORIGIN_HEALTH_RETRY_BUDGET_MAX", 10)
+        self.start_concurrency = settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN")
+        self.hosts = {}
+        self.waiting = set()
+        self.watcher = LoopingCall(self._cancel_waiting)
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.watcher.start(1, now=False)
+
+    def spider_closed(self, spider):
+        if self.watcher.running:
+            self.watcher.stop()
+
+    def _closing(self):
+        engine = self.crawler.engine
+        return not self.crawler.crawling or engine.slot is None or engine.slot.closing is not None
+
+    def _cancel_waiting(self):
+        # the engine only closes once no request is in progress, requests waiting for a paused host would hold it up
+        if self.waiting and self._closing():
+            for dfd in list(self.waiting):
+                dfd.cancel()
+
+    def _wait(self, delay, request, spider):
+        from twisted.internet import reactor
+
+        if self._closing():
+            raise IgnoreRequest(f"Dropped {request}, the spider is closing")
+        dfd = deferLater(reactor, delay, self.process_request, request, spider)
+        dfd.addErrback(self._cancelled, request)
+        self.waiting.add(dfd)
+        dfd.addBoth(self._waited, dfd)
+        return dfd
+
+    def _cancelled(self, failure, request):
+        failure.trap(CancelledError)
+        raise IgnoreRequest(f"Dropped {request}, the spider is closing")
+
+    def _waited(self, result, dfd):
+        self.waiting.discard(dfd)
+        return result
+
+    def _health(self, request):
+        host = urlparse_cached(request).hostname or ''
+        if host not in self.hosts:
+            self.hosts[host] = _OriginHealth(self.window, self.start_concurrency, self.retry_budget_max)
+        return host, self.hosts[host]
+
+    def process_request(self, request, spider):
+        host, health = self._health(request)
+        if not health.healthy:
+            cachedresponse = request.meta.pop("cached_response", None)
+            if cachedresponse is not None:
+                self.stats.inc_value("origin_health/served_cached", spider=spider)
+                return cachedresponse
+            if request.meta.get("revalidate"):
+                raise IgnoreRequest(f"Skipped revalidating {request}, {host} is unhealthy")
+        if health.state == 'open':
+            remaining = health.opened_at + health.cooldown - time()
+            if remaining > 0:
+                return self._wait(remaining, request, spider)
+            health.state = 'half-open'
+        if health.state == 'half-open':
+            if health.probing:
+                return self._wait(1, request, spider)
+            health.probing = True
+            request.meta["origin_probe"] = True
+            logger.info(f"Probing {host} with {request}")
+        return None
+
+    def process_response(self, request, response, spider):
+        if "cached" in response.flags:
+            return response
+        ok = response.status < 500
+        self._record(request, spider, request.meta.get("download_latency"), ok)
+        if not ok:
+            self._spend_retry(request, spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if isinstance(exception, IgnoreRequest):
+            if request.meta.pop("origin_probe", False):
+                self._health(request)[1].probing = False
+            return None
+        self._record(request, spider, None, False)
+        self._spend_retry(request, spider)
+        return None
+
+    def _spend_retry(self, request, spider):
+        host, health = self._health(request)
+        if health.retry_tokens < 1 or not health.healthy:
+            request.meta["dont_retry"] = True
+            self.stats.inc_value("origin_health/retries_denied", spider=spider)
+        else:
+            health.retry_tokens -= 1
+
+    def _record(self, request, spider, latency, ok):
+        host, health = self._health(request)
+        if request.meta.pop("origin_probe", False):
+            health.probing = False
+            if ok:
+                logger.info(f"{host} recovered, closing the circuit")
+                health.state = 'closed'
+                health.samples.clear()
+                health.cooldown = 0
+            else:
+                self._open(host, health, spider)
+            return
+        health.samples.append((latency, ok))
+        if ok:
+            health.retry_tokens = min(self.retry_budget_max, health.retry_tokens + self.retry_budget)
+        if health.healthy and len(health.samples) >= min(10, self.window) and health.error_rate() >= self.error_threshold:
+            self._open(host, health, spider)
+            return
+        health.since_adjusted += 1
+        if health.since_adjusted >= min(10, self.window):
+            health.since_adjusted = 0
+            self._adjust(host, health)
+
+    def _open(self, host, health, spider):
+        health.state = 'open'
+        health.opened_at = time()
+        health.cooldown = min(self.max_cooldown, health.cooldown * 2 or self.cooldown)
+        health.concurrency = self.min_concurrency
+        self._apply(host, health)
+        self.stats.inc_value("origin_health/circuit_opened", spider=spider)
+        logger.warning(f"{host} is failing ({health.error_rate():.0%} errors), pausing it for {health.cooldown:.0f}s")
+
+    def _adjust(self, host, health):
+        latency = health.latency()
+        if latency > self.latency_target:
+            health.concurrency = max(self.min_concurrency, health.concurrency // 2)
+        elif latency < self.latency_target / 2 and health.error_rate() < self.error_threshold / 2:
+            health.concurrency = min(self.max_concurrency, health.concurrency + 1)
+        self._apply(host, health)
+
+    def _apply(self, key, health):
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None:
+            slot.concurrency = health.concurrency
+        self.stats.set_value(f"origin_health/{key}/concurrency", health.concurrency)
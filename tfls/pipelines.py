@@ -4,8 +4,14 @@
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
 from pathlib import Path
+from hashlib import sha1
+from html import unescape
 import json
+import os
+import time
+import re
 import logging
+import tempfile
 from io import BytesIO
 
 from markdownify import MarkdownConverter
@@ -13,16 +19,30 @@ from contextlib import suppress
 from twisted.internet import defer
 
 from itemadapter import ItemAdapter
-from scrapy.pipelines.files import FileException
+from scrapy import Request, signals
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.pipelines.files import FileException, FSFilesStore
 from scrapy.pipelines.images import ImagesPipeline
+from scrapy.utils.log import failure_to_exc_info
 from scrapy.utils.request import referer_str
 
+from .downloads import StreamingDownloader
+from .dedup import SimHashIndex, simhash, text_of
+from .extensions.metrics import timed
+from .manifest import content_hash
+from .pool import ProcessPool
+from .search import SearchIndex
+from .urls import canonical_image_url
+from .writer import FileWriter, write_atomic
+
 logger = logging.getLogger(__name__)
 
 class _ImageBlockConverter(MarkdownConverter):
     def convert_img(self, el, text, convert_as_inline):
         alt = el.attrs.get('alt', None) or ''
         src = el.attrs.get('src', None) or ''
+        srcset = el.attrs.get('srcset', None) or ''
+        sizes = el.attrs.get('sizes', None) or ''
         width = el.attrs.get('width', None) or ''
         height = el.attrs.get('height', None) or ''
         title = el.attrs.get('title', None) or ''
@@ -32,7 +52,9 @@ class _ImageBlockConverter(MarkdownConverter):
 
         return f'''
 <img
-    src="{src}"
+    src="{src}"'''+(f'''
+    srcset="{srcset}"
+    sizes="{sizes}"''' if srcset else '')+'''
     style="display:block;margin-left:auto;margin-right:auto;"
     decoding="async"
     fetchpriority="auto"
@@ -45,49 +67,465 @@ class _ImageBlockConverter(MarkdownConverter):
 def _md(html, **options):
     return _ImageBlockConverter(**options).convert(html)
 
+def _derivative_format(format):
+    from PIL import Image
+
+    Image.init()
+    if format.upper() not in Image.SAVE:
+        logger.warning(f"Pillow cannot encode {format}, using WEBP for image derivatives")
+        return "WEBP"
+    return format.upper()
+
+def _derive(source, store, checksum, widths, format, quality):
+    from PIL import Image
+
+    derivatives = []
+    with Image.open(source) as image:
+        for width in sorted(set(widths)):
+            if width >= image.width:
+                break
+            path = f"derivatives/{checksum}-{width}.{format.lower()}"
+            target = Path(store, path)
+            if not target.exists():
+                target.parent.mkdir(parents=True, exist_ok=True)
+                resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+                # workers of several crawls sharing the store may render the same derivative at once
+                tmp = target.with_name(f"{target.stem}.{os.getpid()}.tmp")
+                resized.save(tmp, format, quality=quality)
+                os.replace(tmp, target)
+            derivatives.append({'width': width, 'path': path})
+    return derivatives
+
+class SkipUnchangedPipeline:
+    @timed("manifest")
+    def process_item(self, item, spider):
+        item['content_hash'] = content_hash(item['content'])
+        entry = spider.manifest.get(item['url'])
+        if spider.manifest.is_unchanged(item['url'], item['content_hash']) and (entry.get('duplicate_of') or Path(entry['path']).exists()):
+            spider.manifest.touch(item['url'])
+            raise DropItem(f"Unchanged: {item['url']}")
+        return item
+
+def _merge(*lists):
+    merged = list(dict.fromkeys(value for values in lists if values for value in values if value is not None))
+    return merged or None
+
+"""
+Drops articles whose text is already exported under another url, typically news reposted into several sections.
+Texts are compared exactly, and by SimHash within DEDUP_SIMHASH_DISTANCE bits when longer than DEDUP_MIN_LENGTH characters.
+Duplicates are recorded in the manifest, their urls become aliases and their categories and tags are merged into the canonical article.
+Canonical articles which are not exported again are patched when the spider closes.
+"""
+class DeduplicatePipeline:
+    def __init__(self, distance, min_length):
+        self.index = SimHashIndex(distance)
+        self.min_length = min_length
+        self.exact = {}
+        self.duplicates = {}
+        self.changed = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.getint("DEDUP_SIMHASH_DISTANCE", 3), crawler.settings.getint("DEDUP_MIN_LENGTH", 50))
+
+    def open_spider(self, spider):
+        self.load(spider.manifest)
+
+    def load(self, manifest):
+        for url, entry in manifest.entries.items():
+            if entry.get('duplicate_of'):
+                self.duplicates.setdefault(entry['duplicate_of'], {})[url] = entry
+            elif entry.get('simhash') is not None:
+                self.index.add(entry['simhash'], url)
+
+    @timed("dedup")
+    def process_item(self, item, spider):
+        text = text_of(item['content'])
+        key = sha1(text.encode()).hexdigest() if len(text) >= self.min_length else item['content_hash']
+        canonical = self.exact.get(key)
+        if canonical is None and len(text) >= self.min_length:
+            item['simhash'] = simhash(text)
+            canonical = self.index.find(item['simhash'])
+        if canonical is None or canonical == item['url']:
+            self.exact.setdefault(key, item['url'])
+            if item.get('simhash') is not None:
+                self.index.add(item['simhash'], item['url'])
+            self.collapse(item)
+            return item
+        entry = {'duplicate_of': canonical, 'categories': item.get('categories'), 'tags': item.get('tags')}
+        spider.manifest.update(item['url'], item['content_hash'], None, **entry)
+        self.duplicates.setdefault(canonical, {})[item['url']] = entry
+        self.changed.add(canonical)
+        raise DropItem(f"Duplicate of {canonical}: {item['url']}")
+
+    def collapse(self, item):
+        duplicates = self.duplicates.get(item['url'], {})
+        if duplicates:
+            item['aliases'] = [_alias(url) for url in sorted(duplicates)]
+            item['categories'] = _merge(item.get('categories'), *(d.get('categories') for d in duplicates.values()))
+            item['tags'] = _merge(item.get('tags'), *(d.get('tags') for d in duplicates.values()))
+
+    def close_spider(self, spider):
+        self.patch(spider.manifest)
+
+    def patch(self, manifest):
+        """Adds the aliases, categories and tags of new duplicates to the exported files of their canonical articles."""
+        for url in sorted(self.changed):
+            entry = manifest.get(url)
+            if entry is None or not entry.get('path') or not Path(entry['path']).exists():
+                continue
+            duplicates = self.duplicates[url]
+            text = Path(entry['path']).read_text()
+            front_matter, end = json.JSONDecoder().raw_decode(text)
+            front_matter['aliases'] = _merge(front_matter.get('aliases'), [_alias(d) for d in sorted(duplicates)])
+            for key in ('categories', 'tags'):
+                merged = _merge(front_matter.get(key), *(d.get(key) for d in duplicates.values()))
+                if merged:
+                    front_matter[key] = merged
+            write_atomic(entry['path'], (json.dumps(front_matter, indent=4, sort_keys=True) + text[end:]).encode())
+
+_src = re.compile(r'''\bsrc=(["'])(.*?)\1''')
+
+"""
+Bounds the memory held by items waiting for their images. Items are admitted with the size of their content and their number of images,
+and released when they are scraped, dropped or fail. While more than ADMISSION_MAX_BYTES of content or ADMISSION_MAX_IMAGES images are
+in flight the engine is paused, so no new pages are downloaded, until both fall under 80% of their limit.
+Content larger than ADMISSION_SPILL_THRESHOLD bytes is moved to a temporary file until RestoreContentPipeline needs it again.
+"""
+class AdmissionControlPipeline:
+    RESUME_AT = 0.8
+
+    def __init__(self, crawler, max_bytes, max_images, spill_threshold, spill_dir):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.max_bytes = max_bytes
+        self.max_images = max_images
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.inflight = {}
+        self.bytes = 0
+        self.images = 0
+        self.paused = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        o = cls(
+            crawler,
+            settings.getint("ADMISSION_MAX_BYTES"),
+            settings.getint("ADMISSION_MAX_IMAGES"),
+            settings.getint("ADMISSION_SPILL_THRESHOLD"),
+            settings.get("ADMISSION_SPILL_DIR"),
+        )
+        for signal in (signals.item_scraped, signals.item_dropped, signals.item_error):
+            crawler.signals.connect(o.release, signal=signal)
+        return o
+
+    @timed("admission")
+    def process_item(self, item, spider):
+        size = len(item['content'].encode())
+        images = len(item.get('image_urls') or [])
+        if self.spill_threshold and size > self.spill_threshold:
+            if self.spill_dir:
+                Path(self.spill_dir).mkdir(parents=True, exist_ok=True)
+            fd, item['content_file'] = tempfile.mkstemp(suffix='.html', dir=self.spill_dir)
+            with os.fdopen(fd, 'w') as f:
+                f.write(item['content'])
+            item['content'] = None
+            self.stats.inc_value("admission/spilled", spider=spider)
+            size = 0
+        self.inflight[id(item)] = (size, images)
+        self.bytes += size
+        self.images += images
+        self.stats.max_value("admission/max_bytes", self.bytes, spider=spider)
+        self.stats.max_value("admission/max_images", self.images, spider=spider)
+        if not self.paused and (self.bytes > self.max_bytes or self.images > self.max_images):
+            self.paused = True
+            self.crawler.engine.pause()
+            self.stats.inc_value("admission/paused", spider=spider)
+            logger.debug(f"Paused the engine with {self.bytes} content bytes and {self.images} images in flight")
+        return item
+
+    def release(self, item, spider, **kwargs):
+        size, images = self.inflight.pop(id(item), (0, 0))
+        self.bytes -= size
+        self.images -= images
+        with suppress(KeyError, TypeError, FileNotFoundError):
+            os.remove(item['content_file'])
+        if self.paused and self.bytes <= self.max_bytes * self.RESUME_AT and self.images <= self.max_images * self.RESUME_AT:
+            self.paused = False
+            self.crawler.engine.unpause()
+            logger.debug(f"Resumed the engine with {self.bytes} content bytes and {self.images} images in flight")
+
+class RestoreContentPipeline:
+    @timed("admission")
+    def process_item(self, item, spider):
+        if item.get('content_file'):
+            with open(item['content_file']) as f:
+                item['content'] = f.read()
+            os.remove(item['content_file'])
+            del item['content_file']
+        return item
+
+def _image_attributes(img, cdn_url, sizes):
+    attributes = f'src="{cdn_url}{img["path"]}" width="{img["size"][0]}" height="{img["size"][1]}"'
+    if img.get('derivatives'):
+        srcset = ', '.join(f"{cdn_url}{d['path']} {d['width']}w" for d in img['derivatives'])
+        attributes += f' srcset="{srcset}, {cdn_url}{img["path"]} {img["size"][0]}w" sizes="{sizes}"'
+    return attributes
+
+def _rewrite_image_urls(content, images, cdn_url, sizes=None):
+    if not images:
+        return content
+    attributes = {img['url']: _image_attributes(img, cdn_url, sizes) for img in images}
+    return _src.sub(lambda m: attributes.get(canonical_image_url(unescape(m.group(2))), m.group(0)), content)
+
 class RewriteImageURLPipeline:
+    def __init__(self, cdn_url, sizes):
+        self.cdn_url = cdn_url
+        self.sizes = sizes
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.get("IMAGES_CDN_URL"), crawler.settings.get("IMAGES_DERIVATIVE_SIZES"))
+
+    @timed("rewrite")
     def process_item(self, item, spider):
-        content = item['content']
-        for img in item.get('images', []):
-            content = content.replace(img['url']+"\"", f"https://cdn.tfls.online/mirror/{img['path']}\" width='{img['size'][0]}' height='{img['size'][1]}'")
-            content = content.replace(img['url']+"\'", f"https://cdn.tfls.online/mirror/{img['path']}\" width='{img['size'][0]}' height='{img['size'][1]}'")
-        item['content'] = content
+        item['content'] = _rewrite_image_urls(item['content'], item.get('images', []), self.cdn_url, self.sizes)
         return item
 
+"""
+Produces resized copies of every stored image in IMAGES_DERIVATIVE_FORMAT for the widths in IMAGES_DERIVATIVE_WIDTHS that are smaller than the image.
+They are encoded in a process pool and named by image checksum under `derivatives/` in IMAGES_STORE, so each one is only encoded once.
+"""
+class ImageDerivativesPipeline:
+    def __init__(self, store, widths, format, quality, workers, queue_size):
+        self.store = store
+        self.widths = widths
+        self.format = format
+        self.quality = quality
+        self.pool = ProcessPool(workers, queue_size)
+        self.derived = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getlist("IMAGES_DERIVATIVE_WIDTHS"):
+            raise NotConfigured
+        workers = settings.get("IMAGES_DERIVATIVE_WORKERS")
+        return cls(
+            settings.get("IMAGES_STORE"),
+            [int(width) for width in settings.getlist("IMAGES_DERIVATIVE_WIDTHS")],
+            _derivative_format(settings.get("IMAGES_DERIVATIVE_FORMAT", "WEBP")),
+            settings.getint("IMAGES_DERIVATIVE_QUALITY", 80),
+            None if workers is None else int(workers),
+            settings.getint("IMAGES_DERIVATIVE_QUEUE_SIZE", 64),
+        )
+
+    @timed("derivatives")
+    def process_item(self, item, spider):
+        dfds = [self._derive(img) for img in item.get('images', [])]
+        dfd = defer.gatherResults(dfds, consumeErrors=True)
+        dfd.addCallback(lambda _: item)
+        return dfd
+
+    def _derive(self, img):
+        if img['checksum'] not in self.derived:
+            dfd = self.pool.submit(_derive, str(Path(self.store, img['path'])), self.store, img['checksum'], self.widths, self.format, self.quality)
+            dfd.addErrback(self._failed, img)
+            self.derived[img['checksum']] = dfd
+        dfd = defer.Deferred()
+        self.derived[img['checksum']].addCallback(self._derived, img, dfd)
+        return dfd
+
+    def _derived(self, derivatives, img, dfd):
+        img['derivatives'] = derivatives
+        dfd.callback(img)
+        return derivatives
+
+    def _failed(self, failure, img):
+        logger.warning(f"Could not derive images from {img['path']}: {failure.value}")
+        return []
+
+    def close_spider(self, spider):
+        self.pool.close()
+
 class ConvertToMarkdownPipeline:
+    def __init__(self, workers, queue_size):
+        self.pool = ProcessPool(workers, queue_size)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        workers = crawler.settings.get("MARKDOWN_WORKERS")
+        return cls(None if workers is None else int(workers), crawler.settings.getint("MARKDOWN_QUEUE_SIZE"))
+
+    @timed("markdown")
     def process_item(self, item, spider):
-        item['content'] = _md(item['content'], heading_style="ATX") 
+        dfd = self.pool.submit(_md, item['content'], heading_style="ATX")
+        dfd.addCallback(self._converted, item)
+        return dfd
+
+    def _converted(self, content, item):
+        item['content'] = content
         return item
 
+    def close_spider(self, spider):
+        self.pool.close()
+
+def _search_document(item):
+    doc = {'url': item['url'], 'title': item.get('title'), 'path': f"{item['path']}/{item['slug']}", 'date': item.get('date')}
+    return doc, f"{item.get('title') or ''}\n{item['content']}"
+
+"""
+Adds every exported article to the SearchIndex in SEARCH_INDEX_DIR. Only new and changed articles reach this stage,
+the index is loaded when the spider opens and written when it closes.
+"""
+class SearchIndexPipeline:
+    def __init__(self, directory, shards):
+        self.directory = directory
+        self.shards = shards
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.get("SEARCH_INDEX_DIR"):
+            raise NotConfigured
+        return cls(crawler.settings.get("SEARCH_INDEX_DIR"), crawler.settings.getint("SEARCH_INDEX_SHARDS", 64))
+
+    def open_spider(self, spider):
+        self.index = SearchIndex(self.directory, self.shards)
+
+    def close_spider(self, spider):
+        self.index.save()
+
+    @timed("search")
+    def process_item(self, item, spider):
+        self.index.add(*_search_document(item))
+        return item
+
+def _alias(url):
+    # only pages of the old site have paths worth redirecting
+    if url.startswith('http://tfls.tj.edu.cn/'):
+        return url.replace('http://tfls.tj.edu.cn', '')
+    return None
+
+def _render_markdown(item):
+    md_frontmatter = { 'toc': True,
+        'date': item.get('date', None),
+        'title': item.get('title', None),
+        'params': {
+            'author': item.get('author', None)
+        } if item.get('author', False) else None,
+        'description': item.get('description', None),
+        'summary': item.get('description', None),
+        'isCJKLanguage': True,
+        'aliases': _merge([_alias(item['url'])] if item.get('url', False) else None, item.get('aliases', None)),
+        'slug': item.get('slug', None),
+        'categories': item.get('categories', None),
+        'tags': item.get('tags', None),
+        'weight': item.get('weight', None),
+        'contributors': [] # doks compatibility
+    }
+    for key, value in list(md_frontmatter.items()):
+        if value is None:
+            del md_frontmatter[key]
+    return json.dumps(md_frontmatter, indent=4, sort_keys=True) + '\n' + item['content']
+
 class ExportMarkdownPipeline:
+    def __init__(self, output_dir, queue_size, stats):
+        self.output_dir = output_dir
+        self.writer = FileWriter(queue_size)
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.get("MARKDOWN_OUTPUT_DIR"), crawler.settings.getint("MARKDOWN_WRITER_QUEUE_SIZE"), crawler.stats)
+
+    def open_spider(self, spider):
+        self.writer.start()
+
+    def close_spider(self, spider):
+        self.writer.stop()
+
+    @timed("export")
     def process_item(self, item, spider):
-        dir = f"./.scrapy/output/{item['path']}"
-        Path(dir).mkdir(parents=True, exist_ok=True)
-        self.file = open(f"{dir}/{item['slug']}.md", "w")
-        md_frontmatter = { 'toc': True,
-            'date': item.get('date', None),
-            'title': item.get('title', None),
-            'params': {
-                'author': item.get('author', None)
-            } if item.get('author', False) else None,
-            'description': item.get('description', None),
-            'summary': item.get('description', None),
-            'isCJKLanguage': True,
-            'aliases': [item.get('url', '').replace('http://tfls.tj.edu.cn', '')] if item.get('url', False) else None,
-            'slug': item.get('slug', None),
-            'categories': item.get('categories', None),
-            'tags': item.get('tags', None),
-            'weight': item.get('weight', None),
-            'contributors': [] # doks compatibility
-        }
-        for key, value in list(md_frontmatter.items()):
-            if value is None:
-                del md_frontmatter[key]
-        self.file.write(json.dumps(md_frontmatter, indent=4, sort_keys=True) + '\n' + item['content'])
-        self.file.close()
+        path = f"{self.output_dir}/{item['path']}/{item['slug']}.md"
+        dfd = self.writer.write(path, _render_markdown(item).encode())
+        dfd.addCallback(self._written, item, path, spider)
+        return dfd
+
+    def _written(self, written, item, path, spider):
+        if written is None:
+            self.stats.inc_value("markdown/skipped", spider=spider)
+        else:
+            self.stats.inc_value("markdown/written", spider=spider)
+            self.stats.inc_value("markdown/bytes", written, spider=spider)
+        spider.manifest.update(item['url'], item['content_hash'], path, simhash=item.get('simhash'), date=item.get('date'))
         return item
 
+class _JsonIndex:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, sort_keys=True)
+        os.replace(tmp, self.path)
+
+"""
+Dimensions of stored images by path, and the stored path of every image url seen so far.
+"""
+class _DimensionIndex(_JsonIndex):
+    def __init__(self, path):
+        super().__init__(path)
+        self.aliases = self.entries.pop('aliases', {})
+
+    def save(self):
+        self.entries['aliases'] = self.aliases
+        try:
+            super().save()
+        finally:
+            del self.entries['aliases']
+
+    def set(self, path, checksum, size, format, stored):
+        self.entries[path] = {'checksum': checksum, 'width': size[0], 'height': size[1], 'format': format, 'stored': stored}
+        return self.entries[path]
+
 class ImagesWithMetaPipeline(ImagesPipeline):  
+    def __init__(self, store_uri, download_func=None, settings=None):
+        super().__init__(store_uri, download_func=download_func, settings=settings)
+        self.index = _DimensionIndex(settings.get("IMAGES_INDEX"))
+
+    def close_spider(self, spider):
+        self.index.save()
+
+    @timed("images")
+    def process_item(self, item, spider):
+        return super().process_item(item, spider)
+
+    def get_media_requests(self, item, info):
+        urls = ItemAdapter(item).get(self.images_urls_field, [])
+        return [Request(url) for url in dict.fromkeys(canonical_image_url(url) for url in urls)]
+
+    def file_path(self, request, response=None, info=None, *, item=None):
+        # downloaded images are stored by the hash of their content, so an image is stored once whatever its url
+        if response is not None:
+            return f"full/{sha1(response.body).hexdigest()}.jpg"
+        return self.index.aliases.get(request.url) or super().file_path(request, response, info, item=item)
+
+    def _probe(self, fp):
+        # Image.open only reads the header, the pixel data is never decoded
+        with self._Image.open(fp) as image:
+            return image.size, image.format
+
     def item_completed(self, results, item, info):
         with suppress(KeyError):
             ItemAdapter(item)[self.images_result_field] = [x for ok, x in results if ok]
@@ -123,8 +561,21 @@ class ImagesWithMetaPipeline(ImagesPipeline):
         )
         self.inc_stats(info.spider, status)
 
+        path = self.file_path(request, response=response, info=info, item=item)
+        entry = self.index.get(path)
+        if entry is not None and isinstance(self.store, FSFilesStore) and Path(self.store.basedir, path).exists():
+            # the same image was already stored from another url
+            self.index.aliases[request.url] = path
+            self.inc_stats(info.spider, "duplicate")
+            return {
+                "url": request.url,
+                "path": path,
+                "checksum": entry['checksum'],
+                "status": status,
+                "size": (entry['width'], entry['height'])
+            }
+
         try:
-            path = self.file_path(request, response=response, info=info, item=item)
             checksum = self.file_downloaded(response, request, info, item=item)
         except FileException as exc:
             logger.warning(
@@ -145,14 +596,17 @@ class ImagesWithMetaPipeline(ImagesPipeline):
             )
             raise FileException(str(exc))
 
-        image = self._Image.open(BytesIO(response.body))
+        size, _ = self._probe(BytesIO(response.body))
+        # stored images are always converted to JPEG by ImagesPipeline
+        self.index.set(path, checksum, size, "JPEG", time.time())
+        self.index.aliases[request.url] = path
 
         return {
             "url": request.url,
             "path": path,
             "checksum": checksum,
             "status": status,
-            "size": image.size
+            "size": size
         }
 
     def media_to_download(self, request, info, *, item=None):
@@ -169,6 +623,14 @@ class ImagesWithMetaPipeline(ImagesPipeline):
             if age_days > self.expires:
                 return  # returning None force download
 
+            entry = self.index.get(path)
+            if entry is None:
+                if not isinstance(self.store, FSFilesStore):
+                    return  # returning None force download
+                size, format = self._probe(Path(self.store.basedir, path))
+                entry = self.index.set(path, result.get("checksum", None), size, format, last_modified)
+            self.index.aliases[request.url] = path
+
             referer = referer_str(request)
             logger.debug(
                 "File (uptodate): Downloaded %(medianame)s from %(request)s "
@@ -178,20 +640,16 @@ class ImagesWithMetaPipeline(ImagesPipeline):
             )
             self.inc_stats(info.spider, "uptodate")
 
-            checksum = result.get("checksum", None)
-
-            image = self._Image.open(BytesIO(response.body))
-
             return {
                 "url": request.url,
                 "path": path,
-                "checksum": checksum,
-                "status": status,
-                "size": image.size
+                "checksum": entry['checksum'],
+                "status": "uptodate",
+                "size": (entry['width'], entry['height'])
             }
 
         path = self.file_path(request, info=info, item=item)
-        dfd = defer.maybeDeferred(self.store.stat_file, path, info)
+        dfd = defer.maybeDeferred(self._stat_stored, path, info)
         dfd.addCallback(_onsuccess)
         dfd.addErrback(lambda _: None)
         dfd.addErrback(
@@ -201,4 +659,97 @@ class ImagesWithMetaPipeline(ImagesPipeline):
                 extra={"spider": info.spider},
             )
         )
-        return dfd
\ No newline at end of file
+        return dfd
+
+    def _stat_stored(self, path, info):
+        # answer from the index when possible, stat_file reads the whole file to checksum it
+        entry = self.index.get(path)
+        if entry is not None and isinstance(self.store, FSFilesStore) and Path(self.store.basedir, path).exists():
+            return {"last_modified": entry['stored'], "checksum": entry['checksum']}
+        return self.store.stat_file(path, info)
+
+_href = re.compile(r'''\bhref=(["'])(.*?)\1''')
+
+def _rewrite_file_urls(content, files, cdn_url):
+    if not files:
+        return content
+    hrefs = {f['url']: f'href="{cdn_url}{f["path"]}"' for f in files}
+    return _href.sub(lambda m: hrefs.get(unescape(m.group(2)), m.group(0)), content)
+
+"""
+Mirrors the `ke-insertfile` attachments in `file_urls` to FILES_STORE with a StreamingDownloader and points their links at FILES_CDN_URL.
+Files are stored by content, FILES_INDEX maps every attachment url to its stored file so it is only downloaded once.
+Attachments that fail to download keep linking to the origin and are resumed on the next crawl.
+"""
+class AttachmentsPipeline:
+    def __init__(self, store, cdn_url, index, downloader, stats):
+        self.store = store
+        self.cdn_url = cdn_url
+        self.index = _JsonIndex(index)
+        self.downloader = downloader
+        self.stats = stats
+        self.downloading = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.get("FILES_STORE"):
+            raise NotConfigured
+        downloader = StreamingDownloader(
+            settings.get("FILES_STORE"),
+            settings.getint("FILES_DOWNLOAD_THREADS", 2),
+            settings.getint("FILES_CHUNK_SIZE", 1 << 16),
+            settings.getfloat("DOWNLOAD_TIMEOUT"),
+            {'User-Agent': settings.get("USER_AGENT")},
+        )
+        return cls(settings.get("FILES_STORE"), settings.get("FILES_CDN_URL"), settings.get("FILES_INDEX"), downloader, crawler.stats)
+
+    def open_spider(self, spider):
+        self.downloader.start()
+
+    def close_spider(self, spider):
+        self.downloader.stop()
+        self.index.save()
+
+    @timed("attachments")
+    def process_item(self, item, spider):
+        urls = item.get('file_urls') or []
+        dfd = defer.DeferredList([self._mirror(url, spider) for url in dict.fromkeys(urls)])
+        dfd.addCallback(self._mirrored, item)
+        return dfd
+
+    def _mirror(self, url, spider):
+        entry = self.index.get(url)
+        if entry is not None and Path(self.store, entry['path']).exists():
+            self.stats.inc_value("files/uptodate", spider=spider)
+            return defer.succeed(entry)
+        if url not in self.downloading:
+            dfd = self.downloader.download(url)
+            dfd.addCallback(self._downloaded, spider)
+            dfd.addErrback(self._failed, url, spider)
+            dfd.addBoth(self._done, url)
+            self.downloading[url] = dfd
+        dfd = defer.Deferred()
+        self.downloading[url].addCallback(lambda result: dfd.callback(result) or result)
+        return dfd
+
+    def _downloaded(self, result, spider):
+        self.index.entries[result['url']] = result
+        self.stats.inc_value("files/downloaded", spider=spider)
+        self.stats.inc_value("files/bytes", result['size'], spider=spider)
+        return result
+
+    def _failed(self, failure, url, spider):
+        logger.warning(f"Could not mirror attachment {url}: {failure.value}")
+        self.stats.inc_value("files/failed", spider=spider)
+        return None
+
+    def _done(self, result, url):
+        del self.downloading[url]
+        return result
+
+    def _mirrored(self, results, item):
+        files = [result for ok, result in results if ok and result]
+        item['files'] = files
+        item['content'] = _rewrite_file_urls(item['content'], files, self.cdn_url)
+        return item
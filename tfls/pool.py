@@ -0,0 +1,48 @@
+import multiprocessing
+import signal
+from concurrent.futures import ProcessPoolExecutor
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+def _ignore_sigint():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+"""
+Runs CPU-bound functions in worker processes and returns Deferreds, so they do not block the reactor.
+At most `queue_size` calls are pending at once, later calls wait for a free slot. With no workers calls run inline.
+Workers ignore SIGINT, so a Ctrl-C shutting the crawl down gracefully lets them finish the calls still pending.
+"""
+class ProcessPool:
+    def __init__(self, workers=None, queue_size=64):
+        self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'), initializer=_ignore_sigint) if workers != 0 else None
+        self.semaphore = defer.DeferredSemaphore(queue_size)
+
+    @property
+    def pending(self):
+        return self.semaphore.limit - self.semaphore.tokens
+
+    def submit(self, fn, *args, **kwargs):
+        if self.executor is None:
+            return defer.maybeDeferred(fn, *args, **kwargs)
+        return self.semaphore.run(self._submit, fn, *args, **kwargs)
+
+    def close(self):
+        # the spider only closes once no item is in flight, so nothing pending is left to cancel
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def _submit(self, fn, *args, **kwargs):
+        from twisted.internet import reactor
+
+        dfd = defer.Deferred()
+        future = self.executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda f: reactor.callFromThread(self._fire, dfd, f))
+        return dfd
+
+    def _fire(self, dfd, future):
+        exc = future.exception()
+        if exc is not None:
+            dfd.errback(Failure(exc))
+        else:
+            dfd.callback(future.result())
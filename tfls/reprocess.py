@@ -0,0 +1,68 @@
+import json
+from pathlib import Path
+
+from scrapy.http import Headers, HtmlResponse, Request
+from w3lib.http import headers_raw_to_dict
+
+from .dedup import simhash, text_of
+from .items import PageItem
+from .manifest import content_hash
+from .middlewares import AbsoluteUrlMiddleware
+from .pipelines import _md, _rewrite_file_urls, _rewrite_image_urls
+
+"""
+Worker side of `scrapy reprocess`: turns a cached response into the item the spider and the pipelines up to the Markdown conversion
+would produce, taking images and attachments from the indexes of earlier crawls instead of downloading them.
+"""
+_state = {}
+
+def init(spidercls, options):
+    _state['spider'] = spidercls()
+    _state['middleware'] = AbsoluteUrlMiddleware()
+    _state['options'] = options
+    for name in ('images', 'files'):
+        path = Path(options[f'{name}_index'])
+        _state[name] = json.loads(path.read_text()) if path.exists() else {}
+
+def process(entry):
+    metadata, rawheaders, body = entry
+    spider, options = _state['spider'], _state['options']
+    request = Request(metadata['url'])
+    response = HtmlResponse(metadata['response_url'], status=metadata['status'], headers=Headers(headers_raw_to_dict(rawheaders)), body=body, request=request)
+    response = _state['middleware'].process_response(request, response, spider)
+    # listing pages only lead to other requests
+    if not spider.schema.fields['content'].extract(response.selector.root):
+        return None
+    items = [dict(item) for item in spider.parse(response) if isinstance(item, PageItem)]
+    if not items:
+        return None
+    item = items[0]
+    item['content_hash'] = content_hash(item['content'])
+    text = text_of(item['content'])
+    if len(text) >= options['dedup_min_length']:
+        item['simhash'] = simhash(text)
+    item['images'] = [image for image in map(_image, item.get('image_urls', [])) if image]
+    item['files'] = [_state['files'][url] for url in item.get('file_urls', []) if url in _state['files']
+                     and Path(options['files_store'], _state['files'][url]['path']).exists()]
+    item['content'] = _rewrite_image_urls(item['content'], item['images'], options['images_cdn_url'], options['images_sizes'])
+    item['content'] = _rewrite_file_urls(item['content'], item['files'], options['files_cdn_url'])
+    item['content'] = _md(item['content'], heading_style="ATX")
+    return item
+
+def _image(url):
+    index, options = _state['images'], _state['options']
+    path = index.get('aliases', {}).get(url)
+    entry = index.get(path) if path else None
+    if entry is None or not Path(options['images_store'], path).exists():
+        return None
+    image = {'url': url, 'path': path, 'checksum': entry['checksum'], 'size': (entry['width'], entry['height'])}
+    derivatives = []
+    for width in sorted(set(options['derivative_widths'])):
+        if width >= entry['width']:
+            break
+        derivative = f"derivatives/{entry['checksum']}-{width}.{options['derivative_format'].lower()}"
+        if Path(options['images_store'], derivative).exists():
+            derivatives.append({'width': width, 'path': derivative})
+    if derivatives:
+        image['derivatives'] = derivatives
+    return image
@@ -0,0 +1,29 @@
+from lxml.etree import XPath, tostring
+
+_namespaces = {'re': 'http://exslt.org/regular-expressions'}
+
+"""
+Declarative extraction schema. XPaths are compiled once and every field is evaluated exactly once per document.
+"""
+class Field:
+    def __init__(self, path, many=False):
+        self.xpath = XPath(path, namespaces=_namespaces)
+        self.many = many
+
+    def extract(self, tree):
+        result = [self._serialize(node) for node in self.xpath(tree)]
+        if self.many:
+            return result
+        return result[0] if result else None
+
+    def _serialize(self, node):
+        if isinstance(node, str):
+            return str(node)
+        return tostring(node, method='html', encoding='unicode', with_tail=False)
+
+class Schema:
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def extract(self, tree):
+        return {name: field.extract(tree) for name, field in self.fields.items()}
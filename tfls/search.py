@@ -0,0 +1,158 @@
+import json
+import re
+from array import array
+from bisect import bisect_left
+from base64 import b64decode, b64encode
+from pathlib import Path
+from zlib import crc32
+
+from .writer import write_atomic
+
+_markup = re.compile(r'<[^>]*>|\]\([^)]*\)')
+_tokens = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[a-z0-9]+')
+
+def tokenize(text):
+    """Terms of `text`: overlapping bigrams of CJK runs, single characters of one character runs, and lowercase latin words and numbers."""
+    terms = []
+    for token in _tokens.findall(_markup.sub(' ', text).lower()):
+        if token.isascii() or len(token) == 1:
+            terms.append(token)
+        else:
+            terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+    return terms
+
+def encode(ids):
+    """Sorted document ids as base64 of their delta-encoded varints."""
+    data, last = bytearray(), 0
+    for id in ids:
+        delta, last = id - last, id
+        while delta >= 0x80:
+            data.append(delta & 0x7f | 0x80)
+            delta >>= 7
+        data.append(delta)
+    return b64encode(data).decode('ascii')
+
+def decode(encoded):
+    ids, value, shift, last = array('I'), 0, 0, 0
+    for byte in b64decode(encoded):
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            last += value
+            ids.append(last)
+            value, shift = 0, 0
+    return ids
+
+def shard_of(term, shards):
+    return crc32(term.encode()) % shards
+
+"""
+Inverted index of CJK bigrams, kept as one array of document ids per term and stored as `shards` JSON files of encoded postings
+plus docs.json, so the frontend only loads the shards holding the terms of a query (crc32 of the UTF-8 term modulo the shard count).
+Documents added again get a new id, the postings of their old id are removed in a single pass when the index is saved.
+Documents added again with the same fields and terms keep their id, so the files of an unchanged index are not rewritten.
+"""
+class SearchIndex:
+    def __init__(self, directory, shards=64):
+        self.directory = Path(directory)
+        self.shards = shards
+        self.docs = {}
+        self.ids = {}
+        self.postings = {}
+        self.removed = set()
+        self.next_id = 0
+        # number of terms per document id, counted on the first document added again
+        self.counts = None
+        meta = self.directory / "docs.json"
+        if meta.exists():
+            with open(meta) as f:
+                index = json.load(f)
+            self.shards = index['shards']
+            self.docs = {int(id): doc for id, doc in index['docs'].items()}
+            self.ids = {doc['url']: id for id, doc in self.docs.items()}
+            self.next_id = max(self.docs, default=-1) + 1
+            for shard in range(self.shards):
+                path = self.directory / "shards" / f"{shard}.json"
+                if path.exists():
+                    with open(path) as f:
+                        self.postings.update((term, decode(ids)) for term, ids in json.load(f).items())
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc, text):
+        terms = list(dict.fromkeys(tokenize(text)))
+        if self._unchanged(doc, terms):
+            return
+        id = self._replace(doc, len(terms))
+        for term in terms:
+            self.postings.setdefault(term, array('I')).append(id)
+
+    def merge(self, other, skip=()):
+        """Adds the documents of another index, except those whose url is in `skip`. Returns the urls added."""
+        terms = {}
+        for term, postings in other.postings.items():
+            for id in postings:
+                terms.setdefault(id, []).append(term)
+        ids, added = {}, []
+        for id, doc in sorted(other.docs.items()):
+            if doc['url'] in skip:
+                continue
+            added.append(doc['url'])
+            if not self._unchanged(doc, terms.get(id, ())):
+                ids[id] = self._replace(doc, len(terms.get(id, ())))
+        for term, postings in other.postings.items():
+            merged = [ids[id] for id in postings if id in ids]
+            if merged:
+                self.postings.setdefault(term, array('I')).extend(merged)
+        return added
+
+    def _unchanged(self, doc, terms):
+        """Whether the document with the url of `doc` has the same fields and exactly these terms."""
+        old = self.ids.get(doc['url'])
+        if old is None or self.docs[old] != doc:
+            return False
+        if self.counts is None:
+            self.counts = {}
+            for ids in self.postings.values():
+                for id in ids:
+                    self.counts[id] = self.counts.get(id, 0) + 1
+        if self.counts.get(old, 0) != len(terms):
+            return False
+        for term in terms:
+            ids = self.postings.get(term, ())
+            index = bisect_left(ids, old)
+            if index == len(ids) or ids[index] != old:
+                return False
+        return True
+
+    def _replace(self, doc, count):
+        """Gives `doc` a new id in place of the one of its url, returns the id. Its postings are added by the caller."""
+        if doc['url'] in self.ids:
+            old = self.ids[doc['url']]
+            self.removed.add(old)
+            del self.docs[old]
+        id = self.next_id
+        self.next_id += 1
+        self.docs[id] = doc
+        self.ids[doc['url']] = id
+        if self.counts is not None:
+            self.counts[id] = count
+        return id
+
+    def save(self):
+        if self.removed:
+            for term, ids in list(self.postings.items()):
+                kept = array('I', (id for id in ids if id not in self.removed))
+                if kept:
+                    self.postings[term] = kept
+                else:
+                    del self.postings[term]
+            self.removed = set()
+        shards = [{} for _ in range(self.shards)]
+        for term, ids in self.postings.items():
+            shards[shard_of(term, self.shards)][term] = encode(ids)
+        Path(self.directory, "shards").mkdir(parents=True, exist_ok=True)
+        for shard, postings in enumerate(shards):
+            write_atomic(self.directory / "shards" / f"{shard}.json", json.dumps(postings, ensure_ascii=False, sort_keys=True).encode())
+        write_atomic(self.directory / "docs.json", json.dumps({'shards': self.shards, 'docs': self.docs}, ensure_ascii=False, sort_keys=True).encode())
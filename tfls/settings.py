@@ -11,6 +11,7 @@ BOT_NAME = "tfls"
 
 SPIDER_MODULES = ["tfls.spiders"]
 NEWSPIDER_MODULE = "tfls.spiders"
+COMMANDS_MODULE = "tfls.commands"
 
 LOG_LEVEL='INFO'
 
@@ -45,35 +46,149 @@ DEFAULT_REQUEST_HEADERS = {
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    "scraper.middlewares.ScraperSpiderMiddleware": 543,
-#}
+SPIDER_MIDDLEWARES = {
+    "tfls.dupefilters.ResumeInflightMiddleware": 10,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
+    "tfls.dupefilters.ResumeInflightMiddleware": 10,
     "tfls.middlewares.AbsoluteUrlMiddleware": 543,
+    "scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware": None,
+    "tfls.extensions.httpcache.StaleWhileRevalidateMiddleware": 900,
+    "tfls.middlewares.OriginHealthMiddleware": 950,
 }
 
+# Per host latency and error tracking, see tfls.middlewares.OriginHealthMiddleware
+ORIGIN_HEALTH_ENABLED = True
+ORIGIN_HEALTH_WINDOW = 50
+# Average latency in seconds to keep each host under by adjusting its concurrency
+ORIGIN_HEALTH_LATENCY_TARGET = 5
+ORIGIN_HEALTH_MIN_CONCURRENCY = 1
+ORIGIN_HEALTH_MAX_CONCURRENCY = 16
+# Pause a host once this share of its recent requests failed, and probe it again after the cooldown
+ORIGIN_HEALTH_ERROR_THRESHOLD = 0.5
+ORIGIN_HEALTH_COOLDOWN = 30
+ORIGIN_HEALTH_MAX_COOLDOWN = 600
+# Retries allowed per successful response, and at most in reserve
+ORIGIN_HEALTH_RETRY_BUDGET = 0.2
+ORIGIN_HEALTH_RETRY_BUDGET_MAX = 10
+
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 EXTENSIONS = {
     "scrapy.extensions.telnet.TelnetConsole": None,
+    "tfls.extensions.metrics.StageMetrics": 500,
+    "tfls.extensions.deploy.DeployManifest": 510,
+}
+
+# Files of these trees (name: setting holding the directory) are listed with their hashes after every crawl,
+# see `scrapy deploydiff` for the files to upload and delete
+DEPLOY_MANIFEST_DIR = "./.scrapy/deploy"
+DEPLOY_TREES = {
+    "output": "MARKDOWN_OUTPUT_DIR",
+    "images": "IMAGES_STORE",
+    "files": "FILES_STORE",
+    "search": "SEARCH_INDEX_DIR",
+}
+
+# Stage timings, download latencies and queue depths, see tfls.extensions.metrics
+METRICS_ENABLED = True
+METRICS_INTERVAL = 15
+METRICS_PROMETHEUS_FILE = "./.scrapy/metrics.prom"
+METRICS_JSON_FILE = "./.scrapy/metrics.json"
+METRICS_URL_CLASSES = {
+    "image": r"\.(jpe?g|png|gif|bmp|webp)$",
+    "listing": r"/$",
+    "article": r"\.html$",
 }
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
-    "tfls.pipelines.ImagesWithMetaPipeline": 1,
-    "tfls.pipelines.RewriteImageURLPipeline": 2,
-    "tfls.pipelines.ConvertToMarkdownPipeline": 3,
+    "tfls.pipelines.SkipUnchangedPipeline": 0,
+    "tfls.pipelines.DeduplicatePipeline": 1,
+    "tfls.pipelines.AdmissionControlPipeline": 2,
+    "tfls.pipelines.ImagesWithMetaPipeline": 3,
+    "tfls.pipelines.ImageDerivativesPipeline": 4,
+    "tfls.pipelines.RestoreContentPipeline": 5,
+    "tfls.pipelines.RewriteImageURLPipeline": 6,
+    "tfls.pipelines.AttachmentsPipeline": 7,
+    "tfls.pipelines.ConvertToMarkdownPipeline": 8,
+    "tfls.pipelines.SearchIndexPipeline": 9,
     "tfls.pipelines.ExportMarkdownPipeline": 999
 }
 
+# Pause the crawl while items holding more content bytes or images than this wait in the pipelines
+ADMISSION_MAX_BYTES = 32 * 1024 * 1024
+ADMISSION_MAX_IMAGES = 512
+# Keep content larger than this many bytes in a temporary file while its images are downloaded (0 to disable)
+ADMISSION_SPILL_THRESHOLD = 0
+#ADMISSION_SPILL_DIR = "./.scrapy/spill"
+
 IMAGES_STORE = "./.scrapy/images"
 IMAGES_EXPIRES = 365
+# Dimensions of stored images and the stored image of every canonical image url,
+# so known images are answered without downloading or decoding them
+IMAGES_INDEX = "./.scrapy/images.json"
+IMAGES_CDN_URL = "https://cdn.tfls.online/mirror/"
+# Resized copies of every image for srcset, encoded in a pool of IMAGES_DERIVATIVE_WORKERS processes (one per CPU if unset, inline if 0).
+# AVIF is used only if Pillow can encode it, WEBP otherwise
+IMAGES_DERIVATIVE_WIDTHS = [480, 960, 1440]
+IMAGES_DERIVATIVE_FORMAT = "WEBP"
+IMAGES_DERIVATIVE_QUALITY = 80
+IMAGES_DERIVATIVE_SIZES = "(max-width: 960px) 100vw, 960px"
+#IMAGES_DERIVATIVE_WORKERS = 0
+IMAGES_DERIVATIVE_QUEUE_SIZE = 64
+
+# Attachments are streamed to disk by FILES_DOWNLOAD_THREADS threads in chunks of FILES_CHUNK_SIZE bytes and stored by sha256
+FILES_STORE = "./.scrapy/files"
+FILES_INDEX = "./.scrapy/files.json"
+FILES_CDN_URL = "https://cdn.tfls.online/mirror/files/"
+FILES_DOWNLOAD_THREADS = 2
+FILES_CHUNK_SIZE = 65536
 MEDIA_ALLOW_REDIRECTS = True
 
+# Markdown conversion runs in a pool of MARKDOWN_WORKERS processes (one per CPU if unset, inline if 0)
+# with at most MARKDOWN_QUEUE_SIZE items waiting for a worker
+#MARKDOWN_WORKERS = 0
+MARKDOWN_QUEUE_SIZE = 64
+
+# Markdown files are written on a dedicated I/O thread with at most MARKDOWN_WRITER_QUEUE_SIZE pending writes
+MARKDOWN_OUTPUT_DIR = "./.scrapy/output"
+MARKDOWN_WRITER_QUEUE_SIZE = 64
+
+# Search index of CJK bigrams for the site, split into SEARCH_INDEX_SHARDS files loaded by the frontend on demand
+SEARCH_INDEX_DIR = "./.scrapy/search"
+SEARCH_INDEX_SHARDS = 64
+
+# Schedule all listing pages at once when the pagination pattern of a section can be detected,
+# instead of following the next page links one by one, on the first crawl only (with an empty manifest)
+PAGINATION_FANOUT = True
+PAGINATION_FANOUT_MAX = 500
+
+# Announcements fetched per request from the admission API when syncing it with `-a xsc=1`
+XSC_PAGE_SIZE = 50
+
+# Working directory of `scrapy shardcrawl`, every shard exports into its own subdirectory before the shards are merged
+SHARD_DIR = "./.scrapy/shards"
+
+# Crawl manifest used for incremental re-crawls, articles seen within MANIFEST_MAX_AGE days are not requested again
+MANIFEST_FILE = "./.scrapy/manifest.json"
+MANIFEST_MAX_AGE = 30
+MANIFEST_FLUSH_INTERVAL = 60
+
+# Articles whose text matches an exported article, exactly or within DEDUP_SIMHASH_DISTANCE bits of SimHash, are exported once
+# with the urls, categories and tags of all copies. Texts shorter than DEDUP_MIN_LENGTH characters are only compared exactly
+DEDUP_SIMHASH_DISTANCE = 3
+DEDUP_MIN_LENGTH = 50
+
+# Resumable crawls: run with `-s JOBDIR=./.scrapy/job` to persist the request queue, the seen requests and the requests in flight
+DUPEFILTER_CLASS = "tfls.dupefilters.CompactDupeFilter"
+DUPEFILTER_FLUSH_INTERVAL = 60
+SCHEDULER_DISK_QUEUE = "scrapy.squeues.MarshalLifoDiskQueue"
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 #AUTOTHROTTLE_ENABLED = True
@@ -93,8 +208,23 @@ HTTPCACHE_ENABLED = True
 #HTTPCACHE_EXPIRATION_SECS = 0
 #HTTPCACHE_DIR = "httpcache"
 HTTPCACHE_POLICY = "tfls.extensions.httpcache.ModifiedRFC2616Policy"
+# Freshness lifetimes in seconds for responses without caching headers, the first matching url pattern wins
+HTTPCACHE_FRESHNESS_RULES = {
+    r"\.(jpe?g|png|gif|bmp|webp)$": 3600 * 24 * 365,  # images
+    r"/html/single/": 3600 * 24 * 31,  # single pages
+    r"/html/news/.+\.html$": 3600 * 24 * 31,  # news articles
+    r"/$": 3600 * 24,  # listing pages
+}
+HTTPCACHE_FRESHNESS_DEFAULT = 3600 * 24 * 31
+# Serve expired responses for up to this many seconds while revalidating them in the background
+HTTPCACHE_STALE_WHILE_REVALIDATE = 3600 * 24 * 30
+HTTPCACHE_REVALIDATE_PRIORITY = -100
 #HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+# Cached responses are kept in a single pack file per spider, run `scrapy migratecache` to import an existing filesystem cache
+HTTPCACHE_STORAGE = "tfls.extensions.httpcache.PackedCacheStorage"
+HTTPCACHE_PACK_COMPACT_RATIO = 0.5
+# Let several processes append to the same pack, set for every shard by `scrapy shardcrawl`
+HTTPCACHE_PACK_SHARED = False
 
 # Set settings whose default value is deprecated to a future-proof value
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
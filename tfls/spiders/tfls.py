@@ -1,9 +1,17 @@
+import json
+import math
+import re
+
 import scrapy
 from scrapy.spiders import CrawlSpider
 from ..items import PageItem
+from ..manifest import CrawlManifest, content_hash
+from ..schema import Field, Schema
+from ..urls import canonical_image_url, canonicalize_url
 
 import requests
 from hashlib import md5
+from zlib import crc32
 
 class TflsSpider(CrawlSpider):
     name = "tfls"
@@ -33,28 +41,110 @@ class TflsSpider(CrawlSpider):
         {'name': '历任校长', 'url': 'http://tfls.tj.edu.cn/html/single/principals.html'}
     ]
 
+    schema = Schema(
+        content=Field('//div[@id="content_div"]'),
+        articles=Field('//td[@class="a03"]//a/@href', many=True),
+        next_page=Field('//a[text()="下一页"]/@href'),
+        last_page=Field('//a[text()="尾页" or text()="末页"]/@href'),
+        page_count=Field(r'//text()[re:test(., "共\s*\d+\s*页")]'),
+        title=Field('//div[@id="lm-top01"]/h4/text()'),
+        title_h2=Field('//h2[@id="title_h2"]/text()'),
+        meta=Field('//h5[@id="public_h5"]/text()'),
+        breadcrumb=Field('//div[@id="lm-top02"]/text()'),
+        category=Field('//div[@id="lm-top02"]//a[2]/text()'),
+        tag=Field('//div[@id="lm-top02"]//a[3]/text()'),
+        sidebar=Field('//div[@id="vertmenu"]/ul/li/a/text()', many=True),
+        images=Field('//div[@id="content_div"]//img/@src', many=True),
+        attachments=Field('//div[@id="content_div"]//a[@class="ke-insertfile"]/@href', many=True),
+    )
+    xsc_api = "http://xsc.tfls.tj.edu.cn/micro/zsbm/ann/pageForLogin"
+
+    sidebar_links = Field('//div[@id="vertmenu"]/ul/li/a/@href', many=True)
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.manifest = CrawlManifest.from_settings(crawler.settings)
+        # incremental crawls page sequentially and stop at the first page of known articles
+        spider.fanout = crawler.settings.getbool('PAGINATION_FANOUT') and not spider.manifest.entries
+        return spider
+
     def start_requests(self):
-        for page in self.pages_with_sidebars:
-            yield scrapy.Request(page['url'], self.parse_sidebar)
-        for page in self.pages:
-            yield scrapy.Request(page['url'], self.parse)
+        # -a xsc=1 also syncs the admission announcements, -a xsc=only syncs nothing else, add -a xsc_full=1 to fetch every page
+        xsc = getattr(self, 'xsc', None)
+        if getattr(self, 'sections', None) or getattr(self, 'urls', None):
+            yield from self._refresh_requests()
+        elif xsc != 'only':
+            for index, page in enumerate(self.pages_with_sidebars):
+                if self._in_shard(index, page['url']):
+                    yield scrapy.Request(page['url'], self.parse_sidebar)
+            for index, page in enumerate(self.pages, len(self.pages_with_sidebars)):
+                if self._in_shard(index, page['url']):
+                    yield scrapy.Request(page['url'], self.parse)
+        if xsc and self._in_shard(0, self.xsc_api):
+            yield self._xsc_request(1)
 
-        #yield scrapy.Request(url="http://xsc.tfls.tj.edu.cn/micro/zsbm/ann/pageForLogin", method='POST',body=r'param=%7B%22page%22%3A1%2C%22pageSize%22%3A6%7D', headers={'Accept': 'application/json, text/plain, */*', 'Content-Type': 'application/x-www-form-urlencoded;charset=utf-8'},callback=self.parse_xsc)
+    @classmethod
+    def find_section(cls, name):
+        """The entry of `pages_with_sidebars` or `pages` with this name or path below /html/, e.g. 新闻中心, news or teachers/master."""
+        for page in [*cls.pages_with_sidebars, *cls.pages]:
+            path = page['url'].split('/html/', 1)[1].removesuffix('/').removesuffix('.html')
+            if name in (page['name'], path):
+                return page
+        return None
+
+    def _refresh_requests(self):
+        """Requests of a hot refresh with `-a sections=<name or path>,...` and `-a urls=<article url>,...`, see `scrapy refresh`.
+        The listing pages of the sections and the given articles are downloaded again, whatever the cache holds."""
+        for name in filter(None, getattr(self, 'sections', '').split(',')):
+            page = self.find_section(name)
+            if page is None:
+                self.logger.error(f"Unknown section: {name}")
+                continue
+            yield scrapy.Request(page['url'], self.parse_sidebar if page in self.pages_with_sidebars else self.parse, meta={'refresh': True})
+        for url in filter(None, getattr(self, 'urls', '').split(',')):
+            yield scrapy.Request(canonicalize_url(url), self.parse, meta={'refresh': True}, dont_filter=True)
+
+    def _in_shard(self, index, url):
+        """Whether a start url belongs to this shard of a crawl run with `-a shard=<n> -a shards=<count>`, see `scrapy shardcrawl`.
+        Start urls are assigned by their position with `-a partition=section` (the default), or by the crc32 of the url with `-a partition=hash`."""
+        shards = int(getattr(self, 'shards', 1))
+        if shards == 1:
+            return True
+        key = crc32(url.encode()) if getattr(self, 'partition', 'section') == 'hash' else index
+        return key % shards == int(self.shard)
 
     def parse_sidebar(self, response):
-        yield from response.follow_all(xpath='//div[@id="vertmenu"]/ul/li/a', callback=self.parse)
+        yield from response.follow_all(self.sidebar_links.extract(response.selector.root), callback=self.parse, meta=self._listing_meta(response))
+
+    def _listing_meta(self, response):
+        # listing pages of a hot refresh bypass the cache too, articles are only downloaded when unknown
+        return {'refresh': True} if response.meta.get('refresh') else None
 
     def parse(self, response):
         self.logger.info(f"Found: {response.url}")
-        if not response.xpath('//div[@id="content_div"]').get():
-            yield from response.follow_all(xpath='//td[@class="a03"]//a', callback=self.parse)
-            if response.xpath('//a[text()="下一页"]/text()').get() == '下一页':
-                yield response.follow(response.xpath('//a[text()="下一页"]/@href')[0].get(), callback=self.parse)
+        fields = self.schema.extract(response.selector.root)
+        if not fields['content']:
+            articles = [canonicalize_url(response.urljoin(href)) for href in fields['articles']]
+            unknown = [url for url in articles if not self.manifest.is_known(url)]
+            yield from response.follow_all(unknown, callback=self.parse)
+            # listings are sorted by date, so a page of known articles means the rest are known too
+            if articles and not unknown:
+                self.logger.info(f"Stopped paging at: {response.url}")
+            elif fields['next_page'] and not response.meta.get('paginated'):
+                # a hot refresh only walks the pages holding new articles
+                fanout = self.fanout and not response.meta.get('refresh')
+                pages = self._page_urls(response, fields) if fanout else None
+                if pages:
+                    self.logger.info(f"Scheduling {len(pages)} listing pages of: {response.url}")
+                    yield from response.follow_all(pages, callback=self.parse, meta={'paginated': True})
+                else:
+                    yield response.follow(fields['next_page'], callback=self.parse, meta=self._listing_meta(response))
         else:
             page = PageItem()
-            page['url'] = response.url
-            page['title'] = response.xpath('//div[@id="lm-top01"]/h4/text()').get() or response.xpath('//h2[@id="title_h2"]/text()').get()
-            meta = response.xpath('//h5[@id="public_h5"]/text()').get() 
+            page['url'] = canonicalize_url(response.url)
+            page['title'] = fields['title'] or fields['title_h2']
+            meta = fields['meta']
             if meta:
                 try:
                     author, date = meta.split('  发布日期：')
@@ -62,38 +152,92 @@ class TflsSpider(CrawlSpider):
                     page['date'] = f"{date[0:10]}T00:00:00+08:00"
                 except:
                     pass
-            page['content'] = response.xpath('//div[@id="content_div"]').get()
+            page['content'] = fields['content']
             url_slugs = response.url.rsplit('/')
             page['slug'] = url_slugs[-1].replace('.html', '')
             page['path'] = '/'.join(url_slugs[url_slugs.index('html')+1:-1])
-            if page['path'] != 'principals' and response.xpath('//div[@id="lm-top02"]/text()').get():
-                page['categories'] = [response.xpath('//div[@id="lm-top02"]//a[2]/text()').get()] if response.xpath('//div[@id="lm-top02"]//a[2]/text()').get() else None
-                page['tags'] = [response.xpath('//div[@id="lm-top02"]//a[3]/text()').get()] if response.xpath('//div[@id="lm-top02"]//a[3]/text()').get() else None
-            sidebar = [item.replace('· ', '') for item in response.xpath('//div[@id="vertmenu"]/ul/li/a/text()').getall()] if response.xpath('//div[@id="vertmenu"]/ul/li/a/text()').getall() else None
+            if page['path'] != 'principals' and fields['breadcrumb']:
+                page['categories'] = [fields['category']] if fields['category'] else None
+                page['tags'] = [fields['tag']] if fields['tag'] else None
+            sidebar = [item.replace('· ', '') for item in fields['sidebar']] if fields['sidebar'] else None
             if sidebar and page['title'] in sidebar:
                 sequence = ['school','teachers','institution']
                 page['weight'] = sidebar.index(page['title']) + 1 + (sequence.index(page['path']) +1)*100 if page['path'] in sequence else sidebar.index(page['title']) + 1 
             if page['url'] == 'http://tfls.tj.edu.cn/html/single/principals.html':
                 page['weight'] = 200
-            page['image_urls'] = []
-            for url in response.xpath('//div[@id="content_div"]//img/@src').extract():
-                if 'www.tfls.cn' in url:
-                    url = url.replace('www.tfls.cn', 'tfls.tj.edu.cn')
-                page['image_urls'].append(url)
+            page['image_urls'] = list(dict.fromkeys(canonical_image_url(url) for url in fields['images']))
+            page['file_urls'] = fields['attachments']
             yield page
     
-    def parse_xsc(self, res):
-        items = res.json()['data']['list']
+    def _page_urls(self, response, fields):
+        """Urls of all remaining listing pages, derived from the next and last page links or the page count, or None if the pattern is not recognized."""
+        next_page = re.split(r'(\d+)', response.urljoin(fields['next_page']))
+        if fields['last_page']:
+            last_page = re.split(r'(\d+)', response.urljoin(fields['last_page']))
+            if len(last_page) != len(next_page):
+                return None
+            differing = [i for i, (a, b) in enumerate(zip(next_page, last_page)) if a != b]
+            if len(differing) != 1 or differing[0] % 2 == 0:
+                return None
+            index, last = differing[0], int(last_page[differing[0]])
+        elif fields['page_count']:
+            # without a last page link the page number is taken to be the last number of the next page url
+            if len(next_page) < 2:
+                return None
+            index, last = len(next_page) - 2, int(re.search(r'共\s*(\d+)\s*页', fields['page_count']).group(1))
+        else:
+            return None
+        first = int(next_page[index])
+        if last - first > self.settings.getint('PAGINATION_FANOUT_MAX'):
+            return None
+        return [''.join(next_page[:index] + [str(n)] + next_page[index + 1:]) for n in range(first, last + 1)]
+
+    def closed(self, reason):
+        self.manifest.save()
 
-        for item in items:
+    def _xsc_request(self, page):
+        param = json.dumps({'page': page, 'pageSize': self.settings.getint('XSC_PAGE_SIZE')}, separators=(',', ':'))
+        return scrapy.FormRequest(
+            self.xsc_api, formdata={'param': param}, callback=self.parse_xsc,
+            headers={'Accept': 'application/json, text/plain, */*'},
+            # the API is polled many times a day, cached pages would hide new announcements
+            meta={'xsc_page': page, 'dont_cache': True},
+        )
+
+    def parse_xsc(self, res):
+        data = res.json()['data']
+        known = 0
+        for item in data['list']:
+            if item.get('content') is None:
+                # withdrawn or not yet published, nothing to export or to remember
+                self.logger.info(f"Skipped announcement without content: {item['title']}")
+                continue
             page = PageItem()
+            # announcements are keyed on their API id, titles get edited
+            page['url'] = f"xsc:{item.get('id') or md5(item['title'].encode()).hexdigest()}"
             page['title'] = item['title']
             page['author'] = item['createUser']
             page['date'] = f"{item['publishTime'][0:10]}T00:00:00+08:00"
             page['content'] = item['content']
-            page['slug'] = md5(page['title'].encode()).hexdigest()
+            page['slug'] = page['url'].removeprefix('xsc:')
             page['path'] = 'admission'
             page['description'] = item['brief']
             page['categories'] = ['招生信息']
             page['tags'] = ['小升初']
-            yield page
\ No newline at end of file
+            entry = self.manifest.get(page['url'])
+            if entry is not None and entry.get('date') == page['date'] and entry['hash'] == content_hash(page['content']):
+                self.manifest.touch(page['url'])
+                known += 1
+                continue
+            yield page
+        number = res.meta['xsc_page']
+        pages = math.ceil(int(data['total']) / self.settings.getint('XSC_PAGE_SIZE'))
+        if getattr(self, 'xsc_full', None) is not None:
+            if number == 1:
+                for following in range(2, pages + 1):
+                    yield self._xsc_request(following)
+        # announcements are sorted by publish time, once known ones show up the remaining pages are known too
+        elif known:
+            self.logger.info(f"Stopped syncing announcements at page {number}")
+        elif number < pages:
+            yield self._xsc_request(number + 1)
@@ -0,0 +1,27 @@
+from urllib.parse import urlsplit, urlunsplit
+
+from w3lib.url import canonicalize_url as _canonicalize_url
+
+# other names of the school server
+_aliases = {'www.tfls.cn': 'tfls.tj.edu.cn', 'tfls.cn': 'tfls.tj.edu.cn', 'www.tfls.tj.edu.cn': 'tfls.tj.edu.cn'}
+_http_only = {'tfls.tj.edu.cn', 'xsc.tfls.tj.edu.cn'}
+_default_ports = {('http', 80), ('https', 443)}
+_image_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+
+def canonicalize_url(url):
+    """Canonical form of `url`: aliases of the school server are replaced by its name and always use http,
+    default ports and fragments are removed, percent-encoding and query arguments are normalized."""
+    parts = urlsplit(_canonicalize_url(url.strip()))
+    host = parts.hostname or ''
+    host = _aliases.get(host, host)
+    scheme = 'http' if host in _http_only else parts.scheme
+    # the default port of the scheme the url was given with
+    netloc = host if parts.port is None or (parts.scheme, parts.port) in _default_ports else f"{host}:{parts.port}"
+    return urlunsplit((scheme, netloc, parts.path, parts.query, ''))
+
+def canonical_image_url(url):
+    """Like canonicalize_url, but the query string of image files is dropped, it only busts caches."""
+    parts = urlsplit(canonicalize_url(url))
+    if parts.path.lower().endswith(_image_extensions):
+        parts = parts._replace(query='')
+    return urlunsplit(parts)
@@ -0,0 +1,48 @@
+import os
+from hashlib import sha1
+from pathlib import Path
+
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+def write_atomic(path, data):
+    """Writes `data` to `path` via a temporary file and a rename. Returns the number of bytes written, or None if the file already had this content."""
+    path = Path(path)
+    if path.exists() and sha1(path.read_bytes()).digest() == sha1(data).digest():
+        return None
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return len(data)
+
+"""
+Writes files on a dedicated I/O thread, so disk access never blocks the reactor.
+At most `queue_size` writes are queued at once. Unchanged files are not touched and keep their mtime.
+"""
+class FileWriter:
+    def __init__(self, queue_size=64):
+        self.threadpool = ThreadPool(1, 1, name=self.__class__.__name__)
+        self.semaphore = defer.DeferredSemaphore(queue_size)
+        self.directories = set()
+
+    @property
+    def pending(self):
+        return self.semaphore.limit - self.semaphore.tokens
+
+    def start(self):
+        self.threadpool.start()
+
+    def stop(self):
+        self.threadpool.stop()
+
+    def write(self, path, data):
+        from twisted.internet import reactor
+
+        return self.semaphore.run(threads.deferToThreadPool, reactor, self.threadpool, self._write, Path(path), data)
+
+    def _write(self, path, data):
+        if path.parent not in self.directories:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.directories.add(path.parent)
+        return write_atomic(path, data)